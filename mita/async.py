@@ -1,13 +1,15 @@
 import pecan
 from celery import Celery
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import timedelta, datetime
 import requests
+from requests.adapters import HTTPAdapter
 import jenkins
-import json
 import os
 import logging
+from logging import captureWarnings
 import warnings
-from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.exc import InvalidRequestError, IntegrityError
 from mita import util, models, connections, providers
 from mita.exceptions import CloudNodeNotFound
 from celery.signals import worker_init
@@ -19,32 +21,59 @@ try:
 except ImportError:
     from logutils.dictconfig import dictConfig as load_logging_config  # noqa
 
+# ujson is a faster drop-in for encoding request bodies, but it is optional
+try:
+    import ujson as json
+except ImportError:
+    import json  # noqa
+
 logger = logging.getLogger(__name__)
 
+# Tasks talk to the mita API once per node, share a single session so that
+# those requests reuse pooled connections instead of opening a new one every
+# time. The adapter is mounted in ``bootstrap_pecan`` once configuration is
+# available.
+SESSION = requests.Session()
+
+# Built once per worker in ``bootstrap_pecan`` so that tasks do not need to
+# create (and authenticate) a new Jenkins connection on every run
+JENKINS_CONN = None
+
+# The nodes endpoint of the mita API (e.g. ``http://0.0.0.0:8080/api/nodes/``)
+# is hit for every node, so it is computed once in ``bootstrap_pecan``
+NODES_URL = None
+
+# worker signals can fire more than once per process, logging only needs to be
+# configured the first time
+_LOGGING_CONFIGURED = False
+
+# seconds a Jenkins queue item is not asked nodes for again after a request,
+# see ``models.RequestedTask``
+STUCK_TASK_TTL = 600
+
 
 def configure_celery_logging():
-    logging = pecan.conf.get('logging', {})
+    global _LOGGING_CONFIGURED
+    if _LOGGING_CONFIGURED:
+        return
+    logging_config = pecan.conf.get('logging', {})
     debug = pecan.conf.get('debug', False)
-    if logging:
+    if logging_config:
         if debug:
-            try:
-                #
-                # By default, Python 2.7+ silences DeprecationWarnings.
-                # However, if conf.app.debug is True, we should probably ensure
-                # that users see these types of warnings.
-                #
-                from logging import captureWarnings
-                captureWarnings(True)
-                warnings.simplefilter("default", DeprecationWarning)
-            except ImportError:
-                # No captureWarnings on Python 2.6, DeprecationWarnings are on
-                pass
-
-        if isinstance(logging, Config):
-            logging = logging.to_dict()
-        if 'version' not in logging:
-            logging['version'] = 1
-        load_logging_config(logging)
+            #
+            # By default, Python 2.7+ silences DeprecationWarnings.
+            # However, if conf.app.debug is True, we should probably ensure
+            # that users see these types of warnings.
+            #
+            captureWarnings(True)
+            warnings.simplefilter("default", DeprecationWarning)
+
+        if isinstance(logging_config, Config):
+            logging_config = logging_config.to_dict()
+        if 'version' not in logging_config:
+            logging_config['version'] = 1
+        load_logging_config(logging_config)
+    _LOGGING_CONFIGURED = True
 
 @worker_init.connect
 def bootstrap_pecan(signal, sender, **kw):
@@ -59,12 +88,24 @@ def bootstrap_pecan(signal, sender, **kw):
     # Once configuration is set we need to initialize the models so that we can connect
     # to the DB wth a configured mapper.
     models.init_model()
+    configure_session()
+    global JENKINS_CONN, NODES_URL
+    JENKINS_CONN = connections.jenkins_connection()
+    NODES_URL = get_mita_api('nodes')
+
+
+def configure_session():
+    adapter = HTTPAdapter(
+        pool_connections=pecan.conf.get('pool_connections', 10),
+        pool_maxsize=pecan.conf.get('pool_maxsize', 20),
+    )
+    SESSION.mount('http://', adapter)
 
 
 app = Celery('mita.async', broker='pyamqp://guest@localhost//', include=['mita.tasks'])
 
 
-@app.task
+@app.task(ignore_result=True)
 def check_idling():
     """
     Idling machines that have been lazy for N (configurable) minutes (defaults
@@ -78,35 +119,49 @@ def check_idling():
 
     Once the
     """
-    jenkins_url = pecan.conf.jenkins['url']
-    jenkins_user = pecan.conf.jenkins['user']
-    jenkins_token = pecan.conf.jenkins['token']
-    conn = jenkins.Jenkins(jenkins_url, jenkins_user, jenkins_token)
+    conn = JENKINS_CONN or connections.jenkins_connection()
     ci_nodes = conn.get_nodes()
 
     # determine which nodes are nodes we have added, so that they can be processed:
     mita_nodes = [n for n in ci_nodes if len(n['name'].split('__')) > 1]
 
     if mita_nodes:
-        logger.info('found Jenkins nodes added by this service: %s' % len(mita_nodes))
+        logger.info('found Jenkins nodes added by this service: %s', len(mita_nodes))
         # check if they are idle, and if so, ping the mita API so that it can handle
-        # proper removal of the node if it needs to
-        for n in mita_nodes:
-            node_info = conn.get_node_info(n['name'])
-            uuid = n['name'].split('__')[-1]
-            if node_info.get('idle'):
-                logging.info("found an idle node: %s" % n['name'])
-                node_endpoint = get_mita_api('nodes', uuid, 'idle')
-                requests.post(node_endpoint)
-            else:
-                logger.info('%s is not idle, reset node.idle_since' % n['name'])
-                node_endpoint = get_mita_api('nodes', uuid, 'active')
-                requests.post(node_endpoint)
+        # proper removal of the node if it needs to. Each check is a round trip
+        # to Jenkins and then to mita, so run them concurrently
+        nodes_url = NODES_URL or get_mita_api('nodes')
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            futures = dict(
+                (executor.submit(_probe_node, conn, n, SESSION, nodes_url), n['name'])
+                for n in mita_nodes
+            )
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception:
+                    logger.exception('unable to check idle state for node: %s', futures[future])
     else:
         logger.info('no Jenkins nodes added by this service where found')
 
 
-@app.task
+def _probe_node(conn, node, session, nodes_url):
+    """
+    Ask Jenkins about a single node and let the mita API know if it is idle or
+    active.
+    """
+    node_info = conn.get_node_info(node['name'])
+    uuid = node['name'].split('__')[-1]
+    if node_info.get('idle'):
+        logger.info("found an idle node: %s", node['name'])
+        node_endpoint = '%s%s/idle' % (nodes_url, uuid)
+    else:
+        logger.info('%s is not idle, reset node.idle_since', node['name'])
+        node_endpoint = '%s%s/active' % (nodes_url, uuid)
+    session.post(node_endpoint)
+
+
+@app.task(ignore_result=True)
 def check_queue():
     """
     Specifically checks for the status of the Jenkins queue. The docs are
@@ -160,12 +215,24 @@ def check_queue():
     Since the key 'wheezy' matches the node required by the build system to
     continue it goes off to create it.
     """
-    jenkins_url = pecan.conf.jenkins['url']
-    jenkins_user = pecan.conf.jenkins['user']
-    jenkins_token = pecan.conf.jenkins['token']
-    conn = jenkins.Jenkins(jenkins_url, jenkins_user, jenkins_token)
+    # queue changes after this point are not seen by this check, so let
+    # notifications schedule another one
+    models.PendingCheck.query.delete()
+    models.commit()
+    conn = JENKINS_CONN or connections.jenkins_connection()
     result = conn.get_queue_info()
     needed_nodes = {}
+    # ids of the tasks nodes are requested for, grouped by node type so that
+    # only the ones for node types that were created get remembered
+    requested_task_ids = {}
+    cutoff = datetime.utcnow() - timedelta(seconds=STUCK_TASK_TTL)
+    models.RequestedTask.query.filter(
+        models.RequestedTask.requested < cutoff
+    ).delete(synchronize_session='fetch')
+    models.commit()
+    recently_requested = set(
+        task_id for task_id, in models.Session.query(models.RequestedTask.task_id)
+    )
 
     if result:
         for task in result:
@@ -175,8 +242,11 @@ def check_queue():
                 # to infer what is needed to get it unstuck
                 continue
             if util.is_stuck(task['why']):
-                logger.info('found stuck task with name: %s' % task['task']['name'])
-                logger.info('reason was: %s' % task['why'])
+                logger.info('found stuck task with name: %s', task['task']['name'])
+                logger.info('reason was: %s', task['why'])
+                if task.get('id') in recently_requested:
+                    logger.info('already requested a node for this task recently, skipping')
+                    continue
                 node_name = util.match_node(task['why'])
                 if not node_name:
                     # this usually happens when jenkins is waiting on an executor
@@ -197,9 +267,9 @@ def check_queue():
                     if not node_name:
                         logger.warning('completely unable to match a node to provide')
                         continue
-                logger.info('inferred node as: %s' % str(node_name))
+                logger.info('inferred node as: %s', node_name)
                 if node_name:
-                    logger.info('matched a node name to config: %s' % node_name)
+                    logger.info('matched a node name to config: %s', node_name)
                     # TODO: this should talk to the pecan app over HTTP using
                     # the `app.conf.pecan_app` configuration entry, and then follow this logic:
                     # * got asked to create a new node -> check for an entry in the DB for a node that
@@ -224,6 +294,8 @@ def check_queue():
                         needed_nodes[node_name] += 1
                     else:
                         needed_nodes[node_name] = 1
+                    if task.get('id') is not None:
+                        requested_task_ids.setdefault(node_name, []).append(task['id'])
                 else:
                     logger.warning('could not match a node name to config for labels')
             else:
@@ -231,18 +303,45 @@ def check_queue():
     elif result == []:
         logger.info('the Jenkins queue is empty, nothing to do')
     else:
-        logger.warning('attempted to get queue info but got: %s' % result)
-    # At this point we might have a bag of nodes that we need to create, go over that
-    # mapping and ask as many as Jenkins needs:
-    node_endpoint = get_mita_api('nodes')
-    for node_name, count in needed_nodes.items():
-        configured_node = pecan.conf.nodes[node_name]
-        configured_node['name'] = node_name
-        configured_node['count'] = count
-        requests.post(node_endpoint, data=json.dumps(configured_node))
-
-
-@app.task
+        logger.warning('attempted to get queue info but got: %s', result)
+    # At this point we might have a bag of nodes that we need to create, send
+    # that mapping over in a single request and ask as many as Jenkins needs:
+    if not needed_nodes:
+        return
+    configured_nodes = util.get_nodes()
+    payload = [
+        dict(configured_nodes[node_name], name=node_name, count=count)
+        for node_name, count in needed_nodes.items()
+    ]
+    response = SESSION.post(
+        NODES_URL or get_mita_api('nodes'),
+        data=json.dumps(payload),
+        headers={'Content-Type': 'application/json'}
+    )
+    response.raise_for_status()
+    # a batched request reports the outcome for each node type, a failure for
+    # one of them does not fail the whole request
+    for item in response.json() or []:
+        if item.get('status') != 'ok':
+            logger.warning(
+                'could not create node for %s: %s', item.get('name'), item.get('error')
+            )
+            continue
+        for task_id in requested_task_ids.get(item.get('name'), []):
+            _remember_requested(task_id)
+
+
+def _remember_requested(task_id):
+    models.RequestedTask(task_id)
+    try:
+        models.commit()
+    except IntegrityError:
+        # another worker requested nodes for it at the same time, which is
+        # already remembered
+        models.rollback()
+
+
+@app.task(ignore_result=True)
 def check_orphaned():
     """
     Machines created in providers might be in an error state or some
@@ -251,43 +350,54 @@ def check_orphaned():
     sure they exist in the provider and if so, remove them from the mita
     database and the provider.
     """
-    conn = connections.jenkins_connection()
+    conn = JENKINS_CONN or connections.jenkins_connection()
+    # If a node is less than 15 minutes old then don't do anything because it
+    # might be just taking a while to join Jenkins, so only ask for older ones.
+    # ALERT MR ROBINSON: 15 minutes is a magical number.
+    cutoff = datetime.utcnow() - timedelta(seconds=900)
     try:
-        nodes = models.Node.query.all()
+        nodes = models.Node.query.filter(models.Node.created < cutoff).all()
     except InvalidRequestError:
         logger.exception('could not list nodes')
         models.rollback()
         # we can try again at the next scheduled task run
         return
 
+    # list Jenkins nodes once instead of asking Jenkins about every node
+    jenkins_names = [n['name'] for n in conn.get_nodes()]
+
+    orphans = []
     for node in nodes:
         # it is all good if this node exists in Jenkins. That is the whole
         # reason for its miserable existence, to work for Mr. Jenkins. Let it
         # be.
-        if node.jenkins_name:
-            if conn.node_exists(node.jenkins_name):
-                continue
-        # So this node is not in Jenkins. If it is less than 15 minutes then
-        # don't do anything because it might be just taking a while to join.
-        # ALERT MR ROBINSON: 15 minutes is a magical number.
-        now = datetime.utcnow()
-        difference = now - node.created
-        if difference.seconds > 900:  # magical number alert
-            logger.info("found created node that didn't join Jenkins: %s", node)
-            provider = providers.get(node.provider)
-            # "We often miss opportunity because it's dressed in overalls and
-            # looks like work". Node missed his opportunity here.
-            try:
-                provider.destroy_node(name=node.cloud_name)
-            except CloudNodeNotFound:
-                logger.info("cloud was not found on provider: %s", node.cloud_name)
-                logger.info("will remove node from database, API confirms it no longer exists")
-                node.delete()
-                models.commit()
-            except Exception:
-                logger.exception("unable to destroy node: %s", node.cloud_name)
-                logger.error("will skip database removal")
-                continue
+        if any(node.identifier in name for name in jenkins_names):
+            continue
+        logger.info("found created node that didn't join Jenkins: %s", node)
+        # only plain values are handed over to the threads below, database
+        # objects stay in this one
+        orphans.append(
+            (node.id, node.provider, node.cloud_name, node.cloud_uuid, node.volume_uuid)
+        )
+
+    # destroying is a separate call to the provider per node, run them concurrently
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = dict(
+            (executor.submit(_destroy_orphan, provider, cloud_name, cloud_uuid, volume_uuid), node_id)
+            for node_id, provider, cloud_name, cloud_uuid, volume_uuid in orphans
+        )
+        deleted_ids = [futures[f] for f in as_completed(futures) if f.result()]
+
+    if deleted_ids:
+        # labels keep a reference to their node, detach them like the ORM
+        # would when deleting a single node
+        models.nodes.Label.query.filter(
+            models.nodes.Label.node_id.in_(deleted_ids)
+        ).update({'node_id': None}, synchronize_session=False)
+        models.Node.query.filter(
+            models.Node.id.in_(deleted_ids)
+        ).delete(synchronize_session=False)
+        models.commit()
 
     # providers can purge nodes in error state too, try to prune those as well
     providers_conf =  pecan.conf.provider.to_dict()
@@ -296,6 +406,27 @@ def check_orphaned():
         provider.purge()
 
 
+def _destroy_orphan(provider_name, cloud_name, cloud_uuid, volume_uuid):
+    """
+    Destroy a node that never joined Jenkins. Returns ``True`` when the
+    provider confirms the node no longer exists, so that it can be removed
+    from the database.
+    """
+    provider = providers.get(provider_name)
+    # "We often miss opportunity because it's dressed in overalls and
+    # looks like work". Node missed his opportunity here.
+    try:
+        provider.destroy_node(name=cloud_name, uuid=cloud_uuid, volume_uuid=volume_uuid)
+    except CloudNodeNotFound:
+        logger.info("cloud was not found on provider: %s", cloud_name)
+        logger.info("will remove node from database, API confirms it no longer exists")
+        return True
+    except Exception:
+        logger.exception("unable to destroy node: %s", cloud_name)
+        logger.error("will skip database removal")
+    return False
+
+
 def get_mita_api(endpoint=None, *args):
     """
     Puts together the API url for mita, so that we can talk to it. Optionally, the endpoint
@@ -315,12 +446,16 @@ def get_mita_api(endpoint=None, *args):
         url = endpoints[endpoint]
 
     if args:
-        for part in args:
-            url = os.path.join(url, part)
+        # URLs always use forward slashes, regardless of the OS
+        url = '/'.join((url.rstrip('/'),) + args)
     return url
 
 
 app.conf.update(
+    # nothing ever looks at task results, don't store them
+    CELERY_IGNORE_RESULT=True,
+    CELERY_TASK_RESULT_EXPIRES=60,
+    CELERY_MAX_CACHED_RESULTS=1,
     CELERYBEAT_SCHEDULE={
         'check-orphaned-every-120-seconds': {
             'task': 'async.check_orphaned',
@@ -330,9 +465,11 @@ app.conf.update(
             'task': 'async.check_idling',
             'schedule': timedelta(seconds=30),
         },
-        'add-every-30-seconds': {
+        # queue checks are mostly triggered by notifications to
+        # /api/queue/notify, this is only a fallback in case any are missed
+        'add-every-120-seconds': {
             'task': 'async.check_queue',
-            'schedule': timedelta(seconds=30),
+            'schedule': timedelta(seconds=120),
         },
     },
 )
@@ -74,7 +74,11 @@ class NodeController(object):
                 # we need to terminate this couch potato
                 logger.info("[cloud] destroying node: %s" % self.node.cloud_name)
                 try:
-                    provider.destroy_node(name=self.node.cloud_name)
+                    provider.destroy_node(
+                        name=self.node.cloud_name,
+                        uuid=self.node.cloud_uuid,
+                        volume_uuid=self.node.volume_uuid
+                    )
                 except CloudNodeNotFound:
                     logger.info("node does not exist in cloud provider")
                 # delete from our database
@@ -105,7 +109,9 @@ class NodeController(object):
         else:
             delete_provider_node(
                 providers.get(self.node.provider),
-                self.node.cloud_name
+                self.node.cloud_name,
+                uuid=self.node.cloud_uuid,
+                volume_uuid=self.node.volume_uuid
             )
             delete_jenkins_node(self.node.jenkins_name)
             self.node.delete()
@@ -126,10 +132,29 @@ class NodesController(object):
 
     @expose('json')
     def index(self):
-        provider = providers.get(request.json['provider'])
         # request.json is read-only, since we are going to add extra metadata
         # to get the classes created, make a clean copy
         _json = deepcopy(request.json)
+        if isinstance(_json, dict):
+            self._create_nodes(_json)
+            return
+        # more than one node type can be requested at once by sending a list,
+        # a failure to create one of them should not prevent creating the rest
+        results = []
+        for node_json in _json:
+            name = node_json.get('name')
+            try:
+                self._create_nodes(node_json)
+            except Exception as error:
+                logger.exception('failed to create nodes for: %s', name)
+                models.rollback()
+                results.append({'name': name, 'status': 'error', 'error': str(error)})
+            else:
+                results.append({'name': name, 'status': 'ok'})
+        return results
+
+    def _create_nodes(self, _json):
+        provider = providers.get(_json['provider'])
 
         # Before creating a node, check if it has already been created by us:
         name = _json['name']
@@ -169,16 +194,18 @@ class NodesController(object):
             )
             for i in range(buffered_count):
                 # slap the UUID into the new node details
-                node_kwargs = deepcopy(request.json)
+                node_kwargs = deepcopy(_json)
                 _id = str(uuid.uuid4())
                 node_kwargs['name'] = "%s__%s" % (name, _id)
                 node_kwargs['script'] = script % _id
 
-                provider.create_node(**node_kwargs)
+                cloud_node = provider.create_node(**node_kwargs)
                 node_kwargs.pop('name')
                 Node(
                     name=name,
                     identifier=_id,
+                    cloud_uuid=getattr(cloud_node, 'id', None),
+                    volume_uuid=getattr(cloud_node, 'extra', {}).get('volume_id'),
                     **node_kwargs
                 )
                 models.commit()
@@ -208,16 +235,18 @@ class NodesController(object):
             )
             for i in range(buffered_count):
                 # slap the UUID into the new node details
-                node_kwargs = deepcopy(request.json)
+                node_kwargs = deepcopy(_json)
                 _id = str(uuid.uuid4())
                 node_kwargs['name'] = "%s__%s" % (name, _id)
                 node_kwargs['script'] = script % _id
 
-                provider.create_node(**node_kwargs)
+                cloud_node = provider.create_node(**node_kwargs)
                 node_kwargs.pop('name')
                 Node(
                     name=name,
                     identifier=_id,
+                    cloud_uuid=getattr(cloud_node, 'id', None),
+                    volume_uuid=getattr(cloud_node, 'extra', {}).get('volume_id'),
                     **node_kwargs
                 )
                 models.commit()
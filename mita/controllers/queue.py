@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta
+import logging
+
+from celery import current_app
+from pecan import expose, abort, request
+from sqlalchemy.exc import IntegrityError
+
+from mita import models
+
+logger = logging.getLogger(__name__)
+
+# seconds a scheduled queue check waits before running, so that a burst of
+# notifications ends up in a single check, and how long after that it is
+# dropped if no worker picked it up
+CHECK_COUNTDOWN = 10
+CHECK_EXPIRES = 60
+
+
+class QueueController(object):
+
+    @expose('json')
+    def notify(self):
+        """
+        Jenkins (or anything watching its build queue) can POST here when the
+        queue changes so that it gets checked right away instead of waiting
+        for the next scheduled check. Notifications arriving while a check is
+        already pending are dropped, that check will see their changes.
+        """
+        if request.method != 'POST':
+            abort(405)
+        if not self._claim_check():
+            logger.info('queue change notification received, a queue check is already pending')
+            return
+        logger.info('queue change notification received, scheduling a queue check')
+        # workers register tasks under the ``async`` module name, so send it
+        # by name rather than importing the worker's Celery app here
+        current_app.send_task(
+            'async.check_queue',
+            countdown=CHECK_COUNTDOWN,
+            expires=CHECK_COUNTDOWN + CHECK_EXPIRES,
+        )
+
+    def _claim_check(self):
+        """
+        Mark a queue check as pending, returns ``False`` if one already is.
+        The mark lives in the database because notifications can be handled
+        by more than one process.
+        """
+        now = datetime.utcnow()
+        # a mark older than this belongs to a check that expired before a
+        # worker could run it
+        stale = now - timedelta(seconds=CHECK_COUNTDOWN + CHECK_EXPIRES)
+        claimed = models.PendingCheck.query.filter(
+            models.PendingCheck.scheduled < stale
+        ).update({'scheduled': now}, synchronize_session=False)
+        if claimed:
+            models.commit()
+            return True
+        if models.PendingCheck.get(models.PendingCheck.ID) is not None:
+            return False
+        models.PendingCheck()
+        try:
+            models.commit()
+        except IntegrityError:
+            # another notification got to mark it first
+            models.rollback()
+            return False
+        return True
@@ -1,10 +1,11 @@
 from pecan import expose
-from mita.controllers import nodes, health
+from mita.controllers import nodes, health, queue
 
 
 class ApiController(object):
 
     nodes = nodes.NodesController()
+    queue = queue.QueueController()
 
 
 class RootController(object):
@@ -105,3 +105,4 @@ def flush():
     Session.flush()
 
 from nodes import Node # noqa
+from queue_items import RequestedTask, PendingCheck # noqa
@@ -18,8 +18,11 @@ class Node(Base):
     identifier = Column(String(128), nullable=False, unique=True, index=True)
     idle_since = Column(DateTime)
     provider = Column(String(128))
+    cloud_uuid = Column(String(128))
+    volume_uuid = Column(String(128))
 
-    def __init__(self, name, keyname, image_name, size, identifier, provider, labels=None, **kw):
+    def __init__(self, name, keyname, image_name, size, identifier, provider, labels=None,
+                 cloud_uuid=None, volume_uuid=None, **kw):
         self.name = name
         self.keyname = keyname
         self.image_name = image_name
@@ -28,6 +31,8 @@ class Node(Base):
         self.created = datetime.datetime.utcnow()
         self.idle_since = None
         self.provider = provider
+        self.cloud_uuid = cloud_uuid
+        self.volume_uuid = volume_uuid
         if labels:
             for l in labels:
                 Label(self, l)
@@ -0,0 +1,52 @@
+import datetime
+from sqlalchemy import Column, Integer, DateTime
+from sqlalchemy.orm.exc import DetachedInstanceError
+from mita.models import Base
+
+
+class RequestedTask(Base):
+    """
+    A Jenkins queue item that already got nodes requested for it. A stuck item
+    stays in the queue until a node joins Jenkins, which takes minutes, so
+    without these every queue check would ask for more nodes. They live in the
+    database so that all worker processes see the same ones.
+    """
+
+    __tablename__ = 'requested_tasks'
+    id = Column(Integer, primary_key=True)
+    task_id = Column(Integer, nullable=False, unique=True, index=True)
+    requested = Column(DateTime, nullable=False, index=True)
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.requested = datetime.datetime.utcnow()
+
+    def __repr__(self):
+        try:
+            return '<RequestedTask %r>' % self.task_id
+        except DetachedInstanceError:
+            return '<RequestedTask detached>'
+
+
+class PendingCheck(Base):
+    """
+    Marks that a queue check was scheduled because of a queue notification
+    and has not started yet, so that notifications arriving in the meantime
+    do not schedule more of them. There is at most one, its ``id`` is always
+    ``PendingCheck.ID``.
+    """
+
+    __tablename__ = 'pending_checks'
+    ID = 1
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    scheduled = Column(DateTime, nullable=False)
+
+    def __init__(self):
+        self.id = self.ID
+        self.scheduled = datetime.datetime.utcnow()
+
+    def __repr__(self):
+        try:
+            return '<PendingCheck %s>' % self.scheduled
+        except DetachedInstanceError:
+            return '<PendingCheck detached>'
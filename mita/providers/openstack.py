@@ -1,8 +1,16 @@
 import logging
-from libcloud.compute.types import Provider
-from libcloud.compute.providers import get_driver
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
+from libcloud.common.exceptions import BaseHTTPError
+from libcloud.common.types import InvalidCredsError
+from libcloud.compute.drivers.openstack import (
+    OpenStack_1_1_Connection, OpenStack_1_1_NodeDriver
+)
+from libcloud.compute.types import NodeState
+from time import sleep, time
 import socket
+import threading
 from ssl import SSLError
 import libcloud.security
 from pecan import conf
@@ -28,105 +36,248 @@ socket.setdefaulttimeout(280)
 # have been warned.
 libcloud.security.VERIFY_SSL_CERT = False
 
-OpenStack = get_driver(Provider.OPENSTACK)
+
+class PersistentConnection(OpenStack_1_1_Connection):
+    """
+    libcloud opens a new HTTP connection for every request. When that
+    connection is backed by a ``requests`` session (libcloud 2.0 and newer)
+    keep using it while requests go to the same endpoint, so that they reuse
+    its pool of kept-alive connections instead of doing a new TLS handshake.
+    """
+
+    _endpoint = None
+
+    def connect(self, host=None, port=None, base_url=None, **kwargs):
+        endpoint = (host or self.host, port or self.port, base_url)
+        if endpoint == self._endpoint and hasattr(self.connection, 'session'):
+            return
+        super(PersistentConnection, self).connect(
+            host=host, port=port, base_url=base_url, **kwargs
+        )
+        self._endpoint = endpoint
+
+
+class OpenStack(OpenStack_1_1_NodeDriver):
+    connectionCls = PersistentConnection
+
+
+# it used to be the case that 'state' would be an integer, and that OVH would
+# slap a 7 for a node in ERROR, newer libcloud versions use strings instead
+ERROR_STATES = frozenset([7, 'error', 'ERROR', NodeState.ERROR])
+
+# Images and sizes rarely change but listing them is expensive (there can be
+# thousands of images), so keep them around for a few minutes per set of
+# credentials
+CATALOG_TTL = 300
+_CATALOG_CACHE = {}
+
+# Creating a driver is cheap, but its first request needs to authenticate and
+# fetch the service catalog. Drivers (and their connections) are not safe to
+# use from more than one thread at a time, so keep a pool of idle drivers per
+# set of credentials: callers check one out for as long as they need it and
+# give it back when done, so that threads started later (e.g. by a new
+# executor) reuse them instead of authenticating again.
+DRIVER_POOL_SIZE = 8
+_DRIVERS = {}
+_DRIVERS_LOCK = threading.Lock()
+
+
+def _driver_key():
+    openstack = conf.provider.openstack
+    return (openstack.username, openstack.auth_url, openstack.tenant_name)
 
 
 def get_driver():
+    """
+    Create a new driver, use ``checkout_driver()`` to get a pooled one
+    """
+    openstack = conf.provider.openstack
     driver = OpenStack(
-        conf.provider.openstack.username,
-        conf.provider.openstack.password,
-        ex_force_auth_url=conf.provider.openstack.auth_url,
-        ex_force_auth_version=conf.provider.openstack.auth_version,
-        ex_tenant_name=conf.provider.openstack.tenant_name,
-        ex_force_service_region=conf.provider.openstack.service_region,
+        openstack.username,
+        openstack.password,
+        ex_force_auth_url=openstack.auth_url,
+        ex_force_auth_version=openstack.auth_version,
+        ex_tenant_name=openstack.tenant_name,
+        ex_force_service_region=openstack.service_region,
     )
     return driver
 
 
+@contextmanager
+def checkout_driver():
+    """
+    Take an idle driver from the pool (or create one) for the duration of the
+    block, and put it back afterwards. A driver whose credentials were rejected
+    is not put back.
+    """
+    key = _driver_key()
+    with _DRIVERS_LOCK:
+        idle = _DRIVERS.get(key)
+        driver = idle.pop() if idle else None
+    if driver is None:
+        driver = get_driver()
+    try:
+        yield driver
+    except InvalidCredsError:
+        # its auth token is no good, do not hand it out again
+        raise
+    except Exception:
+        _release_driver(key, driver)
+        raise
+    else:
+        _release_driver(key, driver)
+
+
+def _release_driver(key, driver):
+    with _DRIVERS_LOCK:
+        idle = _DRIVERS.setdefault(key, [])
+        if len(idle) < DRIVER_POOL_SIZE:
+            idle.append(driver)
+
+
+def clear_drivers():
+    with _DRIVERS_LOCK:
+        _DRIVERS.clear()
+
+
+def reauthenticate(func):
+    """
+    A pooled driver holds on to its auth token, if the provider rejects it
+    drop the pooled drivers and retry once with a fresh one.
+
+    The whole function is called again, so only use this on functions that are
+    safe to repeat (reads, or destroying a single resource) and that do not
+    call other decorated functions, which would multiply the retries.
+    """
+    @wraps(func)
+    def wrapper(*args, **kw):
+        try:
+            return func(*args, **kw)
+        except InvalidCredsError:
+            logger.warning('provider rejected credentials, will re-authenticate and retry')
+            clear_drivers()
+            return func(*args, **kw)
+    return wrapper
+
+
+@reauthenticate
 def purge():
     """
     Get rid of nodes in Error state
     """
-    driver = get_driver()
-    nodes = driver.list_nodes()
+    with checkout_driver() as driver:
+        nodes = driver.list_nodes()
     logger.info('looking for nodes in error state for removal')
-    destroyed = 0
-    for node in nodes:
-        # it used to be the case that 'state' would be an integer, and that
-        # OVH would slap a 7 for a node in ERROR. Somehow the __repr__ of the object
-        # will contain that, so try that too
-        error_integer = node.state == 7
-        error_repr = 'state=ERROR' in str(node)
-        error_string = node.state == 'error'
-        if error_integer or error_repr or error_string:
-            destroyed += 1
-            logger.info('destroying node in error state: %s', str(node))
-            node.destroy()
+    to_destroy = [node for node in nodes if node.state in ERROR_STATES]
+    # each destroy is a separate API call, run them concurrently
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        destroyed = [r for r in executor.map(_destroy_errored_node, to_destroy) if r]
     if destroyed:
-        logger.warning('%s nodes destroyed that were found in error state' % destroyed)
+        logger.warning('%s nodes destroyed that were found in error state', len(destroyed))
         return True
     logger.info('no nodes found in error state, nothing was destroyed')
 
 
-def create_node(**kw):
-    name = kw['name']
-    driver = get_driver()
-    images = driver.list_images()
-    sizes = driver.list_sizes()
-    available_sizes = [s for s in sizes if s.name == kw['size']]
-
-    if not available_sizes:
-        logger.error("provider does not have a matching 'size' for %s", kw['size'])
-        logger.error(
-            "no vm will be created. Ensure that '%s' is an available size and that it exists",
-            kw['size']
-        )
-        return
-
-    storage = kw.get("storage")
+def _destroy_errored_node(node):
+    logger.info('destroying node in error state: %s', node)
+    try:
+        with checkout_driver() as driver:
+            driver.destroy_node(node)
+    except Exception:
+        logger.exception('unable to destroy node in error state: %s', node.name)
+        return False
+    return True
 
-    size = available_sizes[0]
-    matching_images = [i for i in images if i.name == kw['image_name']]
 
-    if not matching_images:
-        logger.error("provider does not have a matching 'image_name' for %s", kw['image_name'])
-        logger.error(
-            "no vm will be created. Ensure that '%s' is an available image and that it exists",
-            kw['image_name']
-        )
-        return
+def _cached_catalog(driver, catalog, refresh=False):
+    """
+    Return the result of calling ``catalog`` (e.g. ``'list_images'``) on the
+    driver as a mapping of names to items, reusing it for ``CATALOG_TTL``
+    seconds.
+    """
+    # every pooled driver for the same credentials sees the same catalog
+    key = _driver_key() + (catalog,)
+    cached = _CATALOG_CACHE.get(key)
+    if refresh or cached is None or cached[1] < time():
+        by_name = {}
+        for item in getattr(driver, catalog)():
+            # keep the first item when names are repeated
+            by_name.setdefault(item.name, item)
+        cached = (by_name, time() + CATALOG_TTL)
+        _CATALOG_CACHE[key] = cached
+    return cached[0]
+
+
+def _match_catalog(driver, catalog, name):
+    """
+    Find the item named ``name`` in a cached catalog. If it is not there the
+    catalog is fetched again, in case the item was added after caching it.
+    """
+    match = _cached_catalog(driver, catalog).get(name)
+    if match is None:
+        match = _cached_catalog(driver, catalog, refresh=True).get(name)
+    return match
 
-    image = matching_images[0]
 
-    try:
-        new_node = driver.create_node(
-            name=name, image=image, size=size,
-            ex_userdata=kw['script'], ex_keyname=kw['keyname']
-        )
-    except SSLError:
-        new_node = None
-        logger.error("failed to connect to provider, probably a timeout was reached")
-
-    if not new_node:
-        logger.error("provider could not create node with details: %s", str(kw))
-        return
-
-    logger.info("created node: %s", new_node)
-
-    if storage:
-        logger.info("Creating %sgb of storage for: %s", storage, name)
-        new_volume = driver.create_volume(storage, name)
-        # wait for the new volume to become available
-        logger.info("Waiting for volume %s to become available", name)
-        _wait_until_volume_available(new_volume, maybe_in_use=True)
-        # wait for the new node to become available
-        logger.info("Waiting for node %s to become available", name)
-        driver.wait_until_running([new_node])
-        logger.info(" ... available")
-        logger.info("Attaching volume %s...", name)
-        if driver.attach_volume(new_node, new_volume, '/dev/vdb') is not True:
-            raise RuntimeError("Could not attach volume %s" % name)
-        logger.info("Successfully attached volume %s", name)
+def create_node(**kw):
+    name = kw['name']
+    with checkout_driver() as driver:
+        size = _match_catalog(driver, 'list_sizes', kw['size'])
+
+        if not size:
+            logger.error("provider does not have a matching 'size' for %s", kw['size'])
+            logger.error(
+                "no vm will be created. Ensure that '%s' is an available size and that it exists",
+                kw['size']
+            )
+            return
+
+        storage = kw.get("storage")
+
+        image = _match_catalog(driver, 'list_images', kw['image_name'])
+
+        if not image:
+            logger.error("provider does not have a matching 'image_name' for %s", kw['image_name'])
+            logger.error(
+                "no vm will be created. Ensure that '%s' is an available image and that it exists",
+                kw['image_name']
+            )
+            return
+
+        try:
+            new_node = driver.create_node(
+                name=name, image=image, size=size,
+                ex_userdata=kw['script'], ex_keyname=kw['keyname']
+            )
+        except SSLError:
+            new_node = None
+            logger.error("failed to connect to provider, probably a timeout was reached")
+
+        if not new_node:
+            logger.error("provider could not create node with details: %s", kw)
+            return
+
+        logger.info("created node: %s", new_node)
+
+        if storage:
+            logger.info("Creating %sgb of storage for: %s", storage, name)
+            new_volume = driver.create_volume(storage, name)
+            # callers store it along with the node, to destroy the volume by
+            # its id later on
+            new_node.extra['volume_id'] = new_volume.id
+            # wait for the new volume to become available
+            logger.info("Waiting for volume %s to become available", name)
+            _wait_until_volume_available(new_volume, maybe_in_use=True)
+            # wait for the new node to become available
+            logger.info("Waiting for node %s to become available", name)
+            driver.wait_until_running([new_node])
+            logger.info(" ... available")
+            logger.info("Attaching volume %s...", name)
+            if driver.attach_volume(new_node, new_volume, '/dev/vdb') is not True:
+                raise RuntimeError("Could not attach volume %s" % name)
+            logger.info("Successfully attached volume %s", name)
+
+        return new_node
 
 
 def _wait_until_volume_available(volume, maybe_in_use=False):
@@ -157,10 +308,12 @@ def _wait_until_volume_available(volume, maybe_in_use=False):
         ok_states.append('in_use')
     logger.info('Volume: %s is in state: %s', volume.name, volume.state)
     while volume.state in ok_states:
-        sleep(3)
-        volume = get_volume(volume.name)
+        # back off exponentially (0.5s, 1s, 2s, then every 4s) so that volumes
+        # that are quick to provision are picked up early, for ~30s in total
+        sleep(min(0.5 * 2 ** tries, 4))
+        volume = get_volume(volume.name, volume_id=getattr(volume, 'id', None))
         tries = tries + 1
-        if tries > 10:
+        if tries > 8:
             logger.info("Maximum amount of tries reached..")
             break
         if volume.state == 'notfound':
@@ -189,9 +342,26 @@ class UnavailableVolume(object):
         self.state = state
 
 
-def get_volume(name):
-    """ Return libcloud.compute.base.StorageVolume """
-    driver = get_driver()
+@reauthenticate
+def get_volume(name, volume_id=None):
+    """
+    Return libcloud.compute.base.StorageVolume
+
+    If the ``volume_id`` is known the volume is fetched directly, otherwise
+    all volumes are listed to find a matching name.
+    """
+    with checkout_driver() as driver:
+        return _get_volume(driver, name, volume_id=volume_id)
+
+
+def _get_volume(driver, name, volume_id=None):
+    if volume_id:
+        try:
+            return driver.ex_get_volume(volume_id)
+        except BaseHTTPError as e:
+            if e.code == 404:
+                return UnavailableVolume(name)
+            raise
     volumes = driver.list_volumes()
     try:
         return [v for v in volumes if v.name == name][0]
@@ -205,29 +375,47 @@ def destroy_node(**kw):
     prevent non-unique names to be used/added.
     TODO: raise an exception if more than one node is matched to the name, that
     can be propagated back to the client.
+
+    The cloud ids of the node and its volume (``uuid`` and ``volume_uuid``)
+    are used to fetch them directly when given, otherwise they are looked up
+    by name.
     """
-    driver = get_driver()
     name = kw['name']
-    nodes = driver.list_nodes()
-    for node in nodes:
-        if node.name == name:
-            try:
-                result = driver.destroy_node(node)
-                if not result:
-                    raise RuntimeError('API failed to destroy node: %s', name)
-                destroy_volume(name)
-                return
-            except Exception:
-                logger.exception('unable to destroy_node: %s', name)
-                raise
-
-    raise CloudNodeNotFound
-
-
-def destroy_volume(name):
-    driver = get_driver()
-    volume = get_volume(name)
-    # check to see if this is a valid volume
-    if volume.state != "notfound":
-        logger.info("Destroying volume %s", name)
-        driver.destroy_volume(volume)
+    # the node and its volume are destroyed separately so that a retry after
+    # re-authenticating only repeats the step that failed
+    _destroy_node(name, kw.get('uuid'))
+    destroy_volume(name, volume_id=kw.get('volume_uuid'))
+
+
+@reauthenticate
+def _destroy_node(name, uuid=None):
+    with checkout_driver() as driver:
+        if uuid:
+            node = driver.ex_get_node_details(uuid)
+            nodes = [node] if node else []
+        else:
+            # nodes created before their cloud uuid was recorded can only be
+            # found by listing everything
+            nodes = driver.list_nodes()
+        for node in nodes:
+            if node.name == name:
+                try:
+                    result = driver.destroy_node(node)
+                    if not result:
+                        raise RuntimeError('API failed to destroy node: %s', name)
+                    return
+                except Exception:
+                    logger.exception('unable to destroy_node: %s', name)
+                    raise
+
+        raise CloudNodeNotFound
+
+
+@reauthenticate
+def destroy_volume(name, volume_id=None):
+    with checkout_driver() as driver:
+        volume = _get_volume(driver, name, volume_id=volume_id)
+        # check to see if this is a valid volume
+        if volume.state != "notfound":
+            logger.info("Destroying volume %s", name)
+            driver.destroy_volume(volume)
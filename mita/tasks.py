@@ -14,7 +14,9 @@ def delete_node(node_id):
 
     util.delete_provider_node(
         providers.get(node.provider),
-        node.cloud_name
+        node.cloud_name,
+        uuid=node.cloud_uuid,
+        volume_uuid=node.volume_uuid
     )
     util.delete_jenkins_node(node.jenkins_name)
     node.delete()
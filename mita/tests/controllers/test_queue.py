@@ -0,0 +1,50 @@
+import datetime
+
+from mita import models
+from mita.controllers import queue
+
+
+class TestQueueController(object):
+
+    def patch(self, monkeypatch):
+        sent = []
+        monkeypatch.setattr(
+            queue.current_app, "send_task", lambda name, **kw: sent.append((name, kw))
+        )
+        return sent
+
+    def test_notify_schedules_queue_check(self, session, monkeypatch):
+        sent = self.patch(monkeypatch)
+        result = session.app.post("/api/queue/notify/")
+        assert result.status_int == 200
+        assert [name for name, kw in sent] == ['async.check_queue']
+        assert sent[0][1]['countdown'] == queue.CHECK_COUNTDOWN
+
+    def test_quick_notifications_schedule_one_check(self, session, monkeypatch):
+        sent = self.patch(monkeypatch)
+        session.app.post("/api/queue/notify/")
+        session.app.post("/api/queue/notify/")
+        assert len(sent) == 1
+
+    def test_notify_schedules_again_once_check_started(self, session, monkeypatch):
+        sent = self.patch(monkeypatch)
+        session.app.post("/api/queue/notify/")
+        # what check_queue does when it starts
+        models.PendingCheck.query.delete()
+        models.commit()
+        session.app.post("/api/queue/notify/")
+        assert len(sent) == 2
+
+    def test_notify_replaces_expired_check(self, session, monkeypatch):
+        sent = self.patch(monkeypatch)
+        pending = models.PendingCheck()
+        pending.scheduled -= datetime.timedelta(
+            seconds=queue.CHECK_COUNTDOWN + queue.CHECK_EXPIRES + 1
+        )
+        models.commit()
+        session.app.post("/api/queue/notify/")
+        assert len(sent) == 1
+
+    def test_notify_requires_post(self, session):
+        result = session.app.get("/api/queue/notify/", expect_errors=True)
+        assert result.status_int == 405
@@ -21,6 +21,59 @@ class TestNodesController(object):
         )
         assert result.status_int == 200
 
+    def test_create_multiple_nodes(self, session):
+        node = {
+            'provider': 'openstack',
+            'keyname': 'ci-key',
+            'image_name': 'beefy-wheezy',
+            'size': '3xlarge',
+            'script': '#!/bin/bash echo hello world! %s',
+            'labels': ['wheezy', 'debian'],
+        }
+        result = session.app.post_json(
+            '/api/nodes/',
+            params=[
+                dict(node, name='wheezy'),
+                dict(node, name='jessie'),
+            ]
+        )
+        assert result.status_int == 200
+        assert Node.filter_by(name='wheezy').count() == 1
+        assert Node.filter_by(name='jessie').count() == 1
+        assert result.json == [
+            {'name': 'wheezy', 'status': 'ok'},
+            {'name': 'jessie', 'status': 'ok'},
+        ]
+
+    def test_create_multiple_nodes_one_fails(self, session, monkeypatch):
+        def create_node(**kw):
+            if kw['name'].startswith('wheezy__'):
+                raise RuntimeError('Could not attach volume')
+            return True
+        monkeypatch.setattr("mita.providers.openstack.create_node", create_node)
+        node = {
+            'provider': 'openstack',
+            'keyname': 'ci-key',
+            'image_name': 'beefy-wheezy',
+            'size': '3xlarge',
+            'script': '#!/bin/bash echo hello world! %s',
+            'labels': ['wheezy', 'debian'],
+        }
+        result = session.app.post_json(
+            '/api/nodes/',
+            params=[
+                dict(node, name='wheezy'),
+                dict(node, name='jessie'),
+            ]
+        )
+        assert result.status_int == 200
+        assert Node.filter_by(name='wheezy').count() == 0
+        assert Node.filter_by(name='jessie').count() == 1
+        assert result.json == [
+            {'name': 'wheezy', 'status': 'error', 'error': 'Could not attach volume'},
+            {'name': 'jessie', 'status': 'ok'},
+        ]
+
     def test_idle_is_unset(self, session):
         session.app.post_json(
             '/api/nodes/',
@@ -0,0 +1,213 @@
+import datetime
+import importlib
+import threading
+
+import pytest
+import requests
+from mock import Mock
+from pecan import conf, set_config
+from sqlalchemy.pool import StaticPool
+
+from mita import models
+from mita.exceptions import CloudNodeNotFound
+
+# ``async`` is a reserved word in newer Pythons, import the module by name
+mita_async = importlib.import_module('mita.async')
+
+
+@pytest.fixture
+def sqlite_models():
+    """
+    check_queue and check_orphaned work on the database, use an in-memory one
+    so that these tests do not need a database server.
+    """
+    # a single connection, otherwise every connection gets an empty database
+    sqlalchemy = {
+        'url': 'sqlite://',
+        'poolclass': StaticPool,
+        'connect_args': {'check_same_thread': False},
+    }
+    set_config(
+        {'sqlalchemy': sqlalchemy, 'provider': {'fake': {}}, 'nodes': {}},
+        overwrite=True
+    )
+    # sessions that already exist would not pick up the new engine
+    models.Session.remove()
+    models.init_model()
+    models.Base.metadata.create_all(conf.sqlalchemy.engine)
+    yield models
+    models.Session.remove()
+    models.Base.metadata.drop_all(conf.sqlalchemy.engine)
+
+
+def stuck_task(task_id, node_name='centos6'):
+    return {
+        'id': task_id,
+        'why': '%s is offline' % node_name,
+        'task': {'name': 'ceph-pull-requests', 'url': 'https://jenkins.ceph.com/job/ceph-pull-requests/'},
+    }
+
+
+class TestCheckQueue(object):
+
+    @pytest.fixture(autouse=True)
+    def setup(self, sqlite_models):
+        set_config({'nodes': {'centos6': {'labels': ['x86_64'], 'provider': 'openstack'}}})
+        self.conn = Mock()
+        self.session = Mock()
+        self.session.post.return_value.json.return_value = [
+            {'name': 'centos6', 'status': 'ok'}
+        ]
+
+    def requested(self):
+        return set(t.task_id for t in models.RequestedTask.query.all())
+
+    def patch(self, monkeypatch):
+        monkeypatch.setattr(mita_async, 'JENKINS_CONN', self.conn)
+        monkeypatch.setattr(mita_async, 'SESSION', self.session)
+        monkeypatch.setattr(mita_async, 'NODES_URL', 'http://mita.example.com/api/nodes/')
+
+    def test_requests_nodes_for_stuck_tasks(self, monkeypatch):
+        self.patch(monkeypatch)
+        self.conn.get_queue_info.return_value = [stuck_task(1), stuck_task(2)]
+        mita_async.check_queue()
+        assert self.session.post.call_count == 1
+        payload = mita_async.json.loads(self.session.post.call_args[1]['data'])
+        assert payload[0]['name'] == 'centos6'
+        assert payload[0]['count'] == 2
+        assert self.requested() == set([1, 2])
+
+    def test_skips_tasks_requested_recently(self, monkeypatch):
+        self.patch(monkeypatch)
+        self.conn.get_queue_info.return_value = [stuck_task(1)]
+        mita_async.check_queue()
+        mita_async.check_queue()
+        assert self.session.post.call_count == 1
+
+    def test_expired_tasks_are_requested_again(self, monkeypatch):
+        self.patch(monkeypatch)
+        self.conn.get_queue_info.return_value = [stuck_task(1)]
+        task = models.RequestedTask(1)
+        task.requested -= datetime.timedelta(seconds=mita_async.STUCK_TASK_TTL + 1)
+        models.commit()
+        mita_async.check_queue()
+        assert self.session.post.call_count == 1
+
+    def test_failed_request_does_not_mark_tasks(self, monkeypatch):
+        self.patch(monkeypatch)
+        self.conn.get_queue_info.return_value = [stuck_task(1)]
+        self.session.post.return_value.raise_for_status.side_effect = requests.exceptions.HTTPError()
+        with pytest.raises(requests.exceptions.HTTPError):
+            mita_async.check_queue()
+        assert self.requested() == set()
+
+    def test_connection_error_does_not_mark_tasks(self, monkeypatch):
+        self.patch(monkeypatch)
+        self.conn.get_queue_info.return_value = [stuck_task(1)]
+        self.session.post.side_effect = requests.exceptions.ConnectionError()
+        with pytest.raises(requests.exceptions.ConnectionError):
+            mita_async.check_queue()
+        assert self.requested() == set()
+
+    def test_failed_node_type_does_not_mark_its_tasks(self, monkeypatch):
+        self.patch(monkeypatch)
+        set_config({'nodes': {'trusty': {'labels': ['amd64'], 'provider': 'openstack'}}})
+        self.conn.get_queue_info.return_value = [
+            stuck_task(1), stuck_task(2, node_name='trusty')
+        ]
+        self.session.post.return_value.json.return_value = [
+            {'name': 'centos6', 'status': 'ok'},
+            {'name': 'trusty', 'status': 'error', 'error': 'quota exceeded'},
+        ]
+        mita_async.check_queue()
+        assert self.requested() == set([1])
+
+    def test_clears_pending_check(self, monkeypatch):
+        self.patch(monkeypatch)
+        self.conn.get_queue_info.return_value = []
+        models.PendingCheck()
+        models.commit()
+        mita_async.check_queue()
+        assert models.PendingCheck.query.count() == 0
+
+    def test_tasks_requested_by_another_worker_are_skipped(self, monkeypatch):
+        self.patch(monkeypatch)
+        self.conn.get_queue_info.return_value = [stuck_task(1)]
+        models.RequestedTask(1)
+        models.commit()
+        mita_async.check_queue()
+        assert self.session.post.call_count == 0
+
+
+class FakeProvider(object):
+
+    def __init__(self):
+        self.destroyed = []
+        self.purged = False
+        self.lock = threading.Lock()
+
+    def destroy_node(self, name, uuid=None, volume_uuid=None):
+        with self.lock:
+            self.destroyed.append((name, uuid, volume_uuid))
+        if 'gone' in name:
+            raise CloudNodeNotFound
+        if 'fails' in name:
+            raise RuntimeError('API failed')
+
+    def purge(self):
+        self.purged = True
+
+
+class TestCheckOrphaned(object):
+
+    def create_node(self, identifier, minutes_old):
+        node = models.Node(
+            'centos6', 'key', 'centos7', 'small', identifier, 'fake',
+            labels=['x86_64'], cloud_uuid='uuid-' + identifier,
+            volume_uuid='volume-' + identifier,
+        )
+        node.created = datetime.datetime.utcnow() - datetime.timedelta(minutes=minutes_old)
+        return node
+
+    def check_orphaned(self, monkeypatch, jenkins_names):
+        conn = Mock()
+        conn.get_nodes.return_value = [{'name': name} for name in jenkins_names]
+        provider = FakeProvider()
+        monkeypatch.setattr(mita_async, 'JENKINS_CONN', conn)
+        monkeypatch.setattr(mita_async.providers, 'get', lambda name: provider)
+        mita_async.check_orphaned()
+        return provider
+
+    def test_only_old_nodes_missing_from_jenkins_are_destroyed(self, sqlite_models, monkeypatch):
+        for identifier in ('gone', 'fails', 'destroyed', 'joined'):
+            self.create_node(identifier, minutes_old=20)
+        self.create_node('young', minutes_old=5)
+        models.commit()
+        provider = self.check_orphaned(monkeypatch, ['centos6__joined', 'master'])
+        assert sorted(provider.destroyed) == [
+            ('centos6__destroyed', 'uuid-destroyed', 'volume-destroyed'),
+            ('centos6__fails', 'uuid-fails', 'volume-fails'),
+            ('centos6__gone', 'uuid-gone', 'volume-gone'),
+        ]
+        assert provider.purged
+
+    def test_only_nodes_confirmed_gone_are_deleted(self, sqlite_models, monkeypatch):
+        for identifier in ('gone', 'fails', 'destroyed', 'joined'):
+            self.create_node(identifier, minutes_old=20)
+        self.create_node('young', minutes_old=5)
+        models.commit()
+        self.check_orphaned(monkeypatch, ['centos6__joined'])
+        models.Session.remove()
+        remaining = sorted(n.identifier for n in models.Node.query.all())
+        assert remaining == ['destroyed', 'fails', 'joined', 'young']
+        labels = models.nodes.Label.query.all()
+        assert len(labels) == 5
+        # the label of the deleted node is kept, but detached from it
+        assert len([l for l in labels if l.node_id is None]) == 1
+
+    def test_nothing_to_delete(self, sqlite_models, monkeypatch):
+        self.create_node('joined', minutes_old=20)
+        models.commit()
+        provider = self.check_orphaned(monkeypatch, ['centos6__joined'])
+        assert provider.destroyed == []
+        assert models.Node.query.count() == 1
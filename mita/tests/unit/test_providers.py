@@ -1,13 +1,37 @@
 import pytest
+import threading
 from collections import namedtuple
 from mock import Mock
+from libcloud.common.types import InvalidCredsError
+from libcloud.compute.drivers.openstack import OpenStack_1_1_Connection
+from pecan import set_config
 from mita import providers
 from mita.exceptions import CloudNodeNotFound
+from mita.providers import openstack
+
+# tests below replace ``get_driver`` in the module, keep a reference to the
+# real one
+get_driver = openstack.get_driver
+# conftest replaces these for every test, keep the real ones too
+create_node = openstack.create_node
+destroy_node = openstack.destroy_node
+
+
+openstack_config = {'provider': {'openstack': {
+    'username': 'alfredo',
+    'password': 'secret',
+    'auth_url': 'http://openstack.example.com:5000',
+    'auth_version': '2.0_password',
+    'service_region': 'Public',
+    'tenant_name': 'ci',
+}}}
 
 
 class TestOpenStackProvider(object):
 
     def setup(self):
+        set_config(openstack_config, overwrite=True)
+        openstack.clear_drivers()
         self.fake_get_driver = Mock()
         self.node = namedtuple('Node', ['name', 'state'])
         self.node.destroy = Mock()
@@ -32,8 +56,312 @@ class TestOpenStackProvider(object):
         providers.openstack.get_driver = self.fake_get_driver
         assert providers.openstack.purge() is True
 
+    def test_purge_matches_error_string(self):
+        self.fake_get_driver.list_nodes = Mock(return_value=[self.node(name='foo', state='error')])
+        providers.openstack.get_driver = self.fake_get_driver
+        assert providers.openstack.purge() is True
+
+    def test_purge_skips_running_nodes(self):
+        self.fake_get_driver.list_nodes = Mock(return_value=[self.node(name='foo', state='running')])
+        providers.openstack.get_driver = self.fake_get_driver
+        assert providers.openstack.purge() is None
+
+    def test_purge_continues_when_destroy_fails(self):
+        failing = self.node(name='failing', state=7)
+        working = self.node(name='working', state=7)
+
+        def destroy_node(node):
+            if node is failing:
+                raise RuntimeError('API failed')
+            return True
+
+        self.fake_get_driver.list_nodes = Mock(return_value=[failing, working])
+        self.fake_get_driver.destroy_node = Mock(side_effect=destroy_node)
+        providers.openstack.get_driver = self.fake_get_driver
+        assert providers.openstack.purge() is True
+        self.fake_get_driver.destroy_node.assert_any_call(working)
+
     def test_purge_finds_nothing(self):
         self.fake_get_driver.list_nodes = Mock(return_value=[])
         self.fake_get_driver.destroy_node = Mock(return_value=0)
         providers.openstack.get_driver = self.fake_get_driver
         assert providers.openstack.purge() is None
+
+    def test_destroy_volume_by_id(self):
+        volume = Mock(state='available')
+        self.fake_get_driver.ex_get_volume = Mock(return_value=volume)
+        self.fake_get_driver.list_volumes = Mock()
+        providers.openstack.get_driver = self.fake_get_driver
+        openstack.destroy_volume('foo', volume_id='1234')
+        self.fake_get_driver.ex_get_volume.assert_called_with('1234')
+        self.fake_get_driver.destroy_volume.assert_called_with(volume)
+        assert not self.fake_get_driver.list_volumes.called
+
+    def test_destroy_node_by_uuid(self):
+        node = Mock()
+        node.name = 'foo'
+        volume = Mock(state='available')
+        self.fake_get_driver.ex_get_node_details = Mock(return_value=node)
+        self.fake_get_driver.ex_get_volume = Mock(return_value=volume)
+        self.fake_get_driver.list_nodes = Mock()
+        self.fake_get_driver.list_volumes = Mock()
+        providers.openstack.get_driver = self.fake_get_driver
+        destroy_node(name='foo', uuid='1234', volume_uuid='5678')
+        self.fake_get_driver.ex_get_node_details.assert_called_with('1234')
+        self.fake_get_driver.destroy_node.assert_called_with(node)
+        self.fake_get_driver.ex_get_volume.assert_called_with('5678')
+        self.fake_get_driver.destroy_volume.assert_called_with(volume)
+        assert not self.fake_get_driver.list_nodes.called
+        assert not self.fake_get_driver.list_volumes.called
+
+    def test_destroy_node_by_uuid_not_found(self):
+        self.fake_get_driver.ex_get_node_details = Mock(return_value=None)
+        providers.openstack.get_driver = self.fake_get_driver
+        with pytest.raises(CloudNodeNotFound):
+            destroy_node(name='foo', uuid='1234')
+
+    def test_create_node_returns_volume_id(self):
+        openstack._CATALOG_CACHE.clear()
+        size, image = Mock(), Mock()
+        size.name, image.name = 'small', 'centos7'
+        self.fake_get_driver.list_sizes = Mock(return_value=[size])
+        self.fake_get_driver.list_images = Mock(return_value=[image])
+        new_node = Mock(extra={})
+        self.fake_get_driver.create_node = Mock(return_value=new_node)
+        self.fake_get_driver.create_volume = Mock(return_value=Mock(id='5678', state='available'))
+        self.fake_get_driver.attach_volume = Mock(return_value=True)
+        providers.openstack.get_driver = self.fake_get_driver
+        result = create_node(
+            name='foo', size='small', image_name='centos7', script='', keyname='key', storage=10
+        )
+        assert result is new_node
+        assert new_node.extra['volume_id'] == '5678'
+
+    def test_get_volume_by_id_skips_listing(self):
+        volume = Mock()
+        self.fake_get_driver.ex_get_volume = Mock(return_value=volume)
+        self.fake_get_driver.list_volumes = Mock()
+        providers.openstack.get_driver = self.fake_get_driver
+        assert providers.openstack.get_volume('foo', volume_id='1234') is volume
+        assert not self.fake_get_driver.list_volumes.called
+
+
+class TestDriverPool(object):
+
+    def setup(self):
+        set_config(openstack_config, overwrite=True)
+        openstack.clear_drivers()
+
+    def test_get_driver_creates_a_driver(self, monkeypatch):
+        monkeypatch.setattr(openstack, 'OpenStack', lambda *a, **kw: object())
+        assert get_driver() is not get_driver()
+
+    def test_driver_is_reused(self, monkeypatch):
+        monkeypatch.setattr(openstack, 'get_driver', object)
+        with openstack.checkout_driver() as first:
+            pass
+        with openstack.checkout_driver() as second:
+            pass
+        assert first is second
+
+    def test_driver_is_reused_by_other_threads(self, monkeypatch):
+        monkeypatch.setattr(openstack, 'get_driver', object)
+        drivers = []
+
+        def checkout():
+            with openstack.checkout_driver() as driver:
+                drivers.append(driver)
+
+        for i in range(2):
+            thread = threading.Thread(target=checkout)
+            thread.start()
+            thread.join()
+        assert drivers[0] is drivers[1]
+
+    def test_checked_out_drivers_are_not_shared(self, monkeypatch):
+        monkeypatch.setattr(openstack, 'get_driver', object)
+        with openstack.checkout_driver() as first:
+            with openstack.checkout_driver() as second:
+                assert first is not second
+
+    def test_driver_is_given_back_on_errors(self, monkeypatch):
+        monkeypatch.setattr(openstack, 'get_driver', object)
+        with pytest.raises(RuntimeError):
+            with openstack.checkout_driver() as first:
+                raise RuntimeError()
+        with openstack.checkout_driver() as second:
+            assert first is second
+
+    def test_driver_with_invalid_creds_is_dropped(self, monkeypatch):
+        monkeypatch.setattr(openstack, 'get_driver', object)
+        with pytest.raises(InvalidCredsError):
+            with openstack.checkout_driver() as first:
+                raise InvalidCredsError()
+        with openstack.checkout_driver() as second:
+            assert first is not second
+
+    def test_pool_is_bounded(self, monkeypatch):
+        monkeypatch.setattr(openstack, 'get_driver', object)
+        monkeypatch.setattr(openstack, 'DRIVER_POOL_SIZE', 1)
+        with openstack.checkout_driver():
+            with openstack.checkout_driver():
+                pass
+        assert len(openstack._DRIVERS[openstack._driver_key()]) == 1
+
+    def test_invalid_creds_clear_pool_and_retry(self, monkeypatch):
+        monkeypatch.setattr(openstack, 'get_driver', object)
+        calls = []
+
+        @openstack.reauthenticate
+        def fails_once():
+            calls.append(1)
+            if len(calls) == 1:
+                raise InvalidCredsError()
+            return True
+
+        with openstack.checkout_driver():
+            pass
+        assert fails_once() is True
+        assert len(calls) == 2
+        assert openstack._DRIVERS == {}
+
+
+class TestReauthenticate(object):
+
+    def setup(self):
+        set_config(openstack_config, overwrite=True)
+        openstack.clear_drivers()
+        openstack._CATALOG_CACHE.clear()
+        self.driver = Mock()
+        volume = Mock(state='available')
+        volume.name = 'foo'
+        self.driver.list_volumes = Mock(return_value=[volume])
+
+    def test_create_node_is_not_repeated(self, monkeypatch):
+        monkeypatch.setattr(openstack, 'get_driver', lambda: self.driver)
+        size, image = Mock(), Mock()
+        size.name, image.name = 'small', 'centos7'
+        self.driver.list_sizes = Mock(return_value=[size])
+        self.driver.list_images = Mock(return_value=[image])
+        self.driver.create_node = Mock(side_effect=InvalidCredsError())
+        with pytest.raises(InvalidCredsError):
+            create_node(name='foo', size='small', image_name='centos7', script='', keyname='key')
+        assert self.driver.create_node.call_count == 1
+
+    def test_destroy_node_retries_once(self, monkeypatch):
+        monkeypatch.setattr(openstack, 'get_driver', lambda: self.driver)
+        self.driver.ex_get_node_details = Mock(side_effect=InvalidCredsError())
+        with pytest.raises(InvalidCredsError):
+            destroy_node(name='foo', uuid='1234')
+        assert self.driver.ex_get_node_details.call_count == 2
+
+    def test_destroy_node_retry_still_destroys_volume(self, monkeypatch):
+        monkeypatch.setattr(openstack, 'get_driver', lambda: self.driver)
+        node = Mock()
+        node.name = 'foo'
+        self.driver.ex_get_node_details = Mock(side_effect=[InvalidCredsError(), node])
+        destroy_node(name='foo', uuid='1234')
+        self.driver.destroy_node.assert_called_once_with(node)
+        assert self.driver.destroy_volume.call_count == 1
+
+
+class TestPersistentConnection(object):
+
+    def setup(self):
+        self.connects = []
+
+    def connection(self, monkeypatch, session=True):
+        def connect(conn, host=None, port=None, base_url=None, **kw):
+            self.connects.append(host)
+            conn.connection = Mock(spec=['session'] if session else [])
+        monkeypatch.setattr(OpenStack_1_1_Connection, 'connect', connect)
+        conn = openstack.PersistentConnection.__new__(openstack.PersistentConnection)
+        conn.host = 'openstack.example.com'
+        conn.port = 443
+        conn.connection = None
+        return conn
+
+    def test_session_is_reused_for_the_same_endpoint(self, monkeypatch):
+        conn = self.connection(monkeypatch)
+        conn.connect()
+        conn.connect()
+        assert len(self.connects) == 1
+
+    def test_reconnects_to_a_new_endpoint(self, monkeypatch):
+        conn = self.connection(monkeypatch)
+        conn.connect()
+        conn.connect(host='other.example.com')
+        assert self.connects == [None, 'other.example.com']
+
+    def test_reconnects_without_a_session(self, monkeypatch):
+        conn = self.connection(monkeypatch, session=False)
+        conn.connect()
+        conn.connect()
+        assert len(self.connects) == 2
+
+
+class TestWaitUntilVolumeAvailable(object):
+
+    def setup(self):
+        self.sleeps = []
+
+    def test_backs_off_exponentially(self, monkeypatch):
+        creating = Mock(state='creating')
+        creating.name = 'foo'
+        monkeypatch.setattr(openstack, 'sleep', self.sleeps.append)
+        monkeypatch.setattr(openstack, 'get_volume', lambda name, volume_id=None: creating)
+        openstack._wait_until_volume_available(creating)
+        assert self.sleeps == [0.5, 1, 2, 4, 4, 4, 4, 4, 4]
+
+    def test_stops_when_available(self, monkeypatch):
+        creating = Mock(state='creating')
+        available = Mock(state='available')
+        monkeypatch.setattr(openstack, 'sleep', self.sleeps.append)
+        monkeypatch.setattr(openstack, 'get_volume', lambda name, volume_id=None: available)
+        openstack._wait_until_volume_available(creating)
+        assert self.sleeps == [0.5]
+
+
+class TestCatalogCache(object):
+
+    def setup(self):
+        set_config(openstack_config, overwrite=True)
+        openstack._CATALOG_CACHE.clear()
+        self.driver = Mock()
+        self.image = Mock()
+        self.image.name = 'centos7'
+        self.driver.list_images = Mock(return_value=[self.image])
+
+    def test_catalog_is_reused(self):
+        openstack._match_catalog(self.driver, 'list_images', 'centos7')
+        openstack._match_catalog(self.driver, 'list_images', 'centos7')
+        assert self.driver.list_images.call_count == 1
+
+    def test_catalog_expires(self, monkeypatch):
+        openstack._match_catalog(self.driver, 'list_images', 'centos7')
+        monkeypatch.setattr(openstack, 'time', lambda: float('inf'))
+        openstack._match_catalog(self.driver, 'list_images', 'centos7')
+        assert self.driver.list_images.call_count == 2
+
+    def test_miss_refreshes_catalog(self):
+        assert openstack._match_catalog(self.driver, 'list_images', 'centos7') is self.image
+        assert openstack._match_catalog(self.driver, 'list_images', 'rhel7') is None
+        assert self.driver.list_images.call_count == 2
+
+    def test_first_item_wins_for_repeated_names(self):
+        duplicate = Mock()
+        duplicate.name = 'centos7'
+        self.driver.list_images = Mock(return_value=[self.image, duplicate])
+        assert openstack._match_catalog(self.driver, 'list_images', 'centos7') is self.image
+
+    def test_catalog_is_shared_between_drivers(self):
+        openstack._match_catalog(self.driver, 'list_images', 'centos7')
+        other_driver = Mock()
+        assert openstack._match_catalog(other_driver, 'list_images', 'centos7') is self.image
+        assert not other_driver.list_images.called
+
+    def test_catalog_does_not_keep_drivers(self):
+        openstack._match_catalog(self.driver, 'list_images', 'centos7')
+        assert list(openstack._CATALOG_CACHE) == [
+            ('alfredo', 'http://openstack.example.com:5000', 'ci', 'list_images')
+        ]
@@ -1,3 +1,4 @@
+from io import BytesIO
 import requests
 import pytest
 
@@ -70,6 +71,14 @@ class TestFromLabel(object):
         msg = BecauseLabelIsBusy % 'huge&&amd64'
         assert util.from_label(msg) == 'wheezy'
 
+    def test_exact_node_name_skips_label_lookups(self):
+        with patch('mita.util.match_node_from_label') as m_label:
+            assert util.from_label(u'Waiting for next available executor on wheezy') == 'wheezy'
+        assert not m_label.called
+
+    def test_label_with_trailing_whitespace(self):
+        assert util.from_label(u'Waiting for next available executor on amd64 ') == 'wheezy'
+
 
 class TestOfflineLabel(object):
 
@@ -120,6 +129,17 @@ class TestOfflineNode(object):
         msg = BecauseNodeIsOffline % '10.0.0.0_centos6_huge'
         assert util.from_offline_node(msg) == 'centos6'
 
+    def test_remembers_resolved_names(self):
+        msg = BecauseNodeIsOffline % 'centos6__192.168.168.90'
+        util.from_offline_node(msg)
+        assert util._nodes_cache['shortnames']['centos6__192.168.168.90'] == 'centos6'
+
+    def test_resolved_names_are_bounded(self, monkeypatch):
+        monkeypatch.setattr(util, '_SHORTNAMES_MAX', 2)
+        for ip in ('10.0.0.1', '10.0.0.2', '10.0.0.3'):
+            util.from_offline_node(BecauseNodeIsOffline % ('centos6__' + ip))
+        assert len(util._nodes_cache['shortnames']) <= 2
+
 
 class TestFromOfflineNodeLabel(object):
 
@@ -183,6 +203,12 @@ class TestLabelIsMissing(object):
         api_message = "%s;%s;%s" % (offline_msg, node_msg, BecauseLabelIsMissing % ('centos6', 'small&&x86_64'))
         assert util.from_node_without_label(api_message) == 'centos6'
 
+    def test_no_marker_skips_matching(self):
+        api_message = ';'.join([BecauseNodeIsOffline % 'centos6', BecauseNodeIsOffline % 'trusty'])
+        with patch('mita.util.from_label') as m_from_label:
+            assert util.from_node_without_label(api_message) is None
+        assert not m_from_label.called
+
 
 class TestMatchNode(object):
 
@@ -224,6 +250,27 @@ class TestMatchNode(object):
         result = util.match_node(BecauseNodeLabelIsOffline % 'fast&&debian&&amd64')
         assert result is None
 
+    # reasons can match more than one check, the order in which they are
+    # tried decides which processor handles them
+
+    def test_waiting_for_takes_precedence_over_offline_node(self):
+        with patch('mita.util.from_label') as m_from_label:
+            util.match_node('Waiting for next available executor on wheezy is offline')
+        assert m_from_label.called
+
+    def test_offline_label_takes_precedence_over_offline_node(self):
+        with patch('mita.util.from_offline_label') as m_from_offline_label:
+            util.match_node(u'All nodes of label \u2018debian\u2019 are offline; wheezy is offline')
+        assert m_from_offline_label.called
+
+    def test_offline_node_takes_precedence_over_no_nodes_with_label(self):
+        reason = u'There are no nodes with the label \u2018debian\u2019; wheezy is offline'
+        with patch('mita.util.from_offline_node') as m_from_offline_node:
+            with patch('mita.util.from_offline_node_label') as m_from_offline_node_label:
+                util.match_node(reason)
+        assert m_from_offline_node.called
+        assert not m_from_offline_node_label.called
+
 
 class TestGetNodeLabels(object):
 
@@ -269,12 +316,22 @@ class TestGetNodeLabels(object):
         result = util.get_node_labels('trusty', _xml_configuration=xml_string)
         assert result == ['amd64', 'centos7', 'x86_64', 'huge']
 
+    def test_empty_label(self):
+        result = util.get_node_labels('trusty', _xml_configuration='<slave><label/></slave>')
+        assert result == []
+
+    def test_ignores_nested_label(self):
+        xml_string = '<slave><launcher><label>amd64</label></launcher></slave>'
+        result = util.get_node_labels('trusty', _xml_configuration=xml_string)
+        assert result == []
+
 
 stuck_reasons = [
     "Waiting for next available executor on 10.0.1.1",
     "All nodes of label awesomest are busy",
     "SuperNode is offline",
-    "There are no nodes like that"
+    "There are no nodes like that",
+    BecauseLabelIsMissing % ('centos6', 'small'),
 ]
 
 
@@ -282,7 +339,8 @@ garbage_reasons = [
     "All is good",
     "Not waiting for a node",
     "Running test",
-    "Executing on some label"
+    "Executing on some label",
+    "SuperNode is offline for maintenance",
 ]
 
 
@@ -297,6 +355,113 @@ class TestIsStuck(object):
         assert util.is_stuck(why) is False
 
 
+class TestGetNodes(object):
+
+    def setup(self):
+        set_config(
+            {'nodes': {'centos6': {'labels': ['x86_64', 'huge']}}},
+            overwrite=True
+        )
+
+    def test_nodes_are_cached(self):
+        assert util.get_nodes() is util.get_nodes()
+
+    def test_cache_is_refreshed_with_new_config(self):
+        util.get_nodes()
+        set_config({'nodes': {'wheezy': {'labels': ['amd64']}}}, overwrite=True)
+        assert list(util.get_nodes().keys()) == ['wheezy']
+
+    def test_invalidate_cache(self):
+        nodes = util.get_nodes()
+        util.invalidate_nodes_cache()
+        assert util.get_nodes() is not nodes
+
+    def test_label_index(self):
+        util.get_nodes()
+        assert util._nodes_cache['by_label'] == {'x86_64': ['centos6'], 'huge': ['centos6']}
+        assert util._nodes_cache['label_sets'] == {'centos6': frozenset(['x86_64', 'huge'])}
+
+
+class TestGetKey(object):
+
+    def setup(self):
+        set_config(
+            {'nodes': {
+                'centos6': {'labels': ['x86_64']},
+                'centos6_huge': {'labels': ['x86_64', 'huge']},
+            }},
+            overwrite=True
+        )
+
+    def test_exact_key(self):
+        assert util.get_key(util.get_nodes(), 'centos6') == 'centos6'
+
+    def test_fallback_prefers_longest_name(self):
+        key = '10.0.0.1__centos6_huge'
+        assert util.get_key(util.get_nodes(), key) == 'centos6_huge'
+
+    def test_fallback_no_match(self):
+        assert util.get_key(util.get_nodes(), 'trusty__10.0.0.1') is None
+
+    def test_no_fallback(self):
+        assert util.get_key(util.get_nodes(), '10.0.0.1__centos6', fallback=False) is None
+
+    def test_uncached_dict(self):
+        nodes = {'wheezy': {}, 'wheezy_arm': {}}
+        assert util.get_key(nodes, 'wheezy_arm__10.0.0.1') == 'wheezy_arm'
+
+
+class TestMatchNodeFromLabels(object):
+
+    def setup(self):
+        set_config(
+            {'nodes': {
+                'centos6': {'labels': ['x86_64', 'centos', 'small']},
+                'centos7': {'labels': ['x86_64', 'centos', 'huge']},
+            }},
+            overwrite=True
+        )
+
+    def test_all_labels_must_match(self):
+        assert util.match_node_from_labels(['x86_64', 'centos', 'huge']) == 'centos7'
+
+    def test_no_node_has_all_labels(self):
+        assert util.match_node_from_labels(['x86_64', 'small', 'huge']) is None
+
+    def test_unknown_label(self):
+        assert util.match_node_from_labels(['arm64', 'centos']) is None
+
+    def test_explicit_configuration_is_used(self):
+        nodes = {'wheezy': {'labels': ['amd64', 'debian']}}
+        assert util.match_node_from_labels(['amd64', 'debian'], nodes) == 'wheezy'
+        assert util.match_node_from_label('debian', nodes) == 'wheezy'
+
+
+class TestMatchNodeFromLabelExpr(object):
+
+    def setup(self):
+        set_config(
+            {'nodes': {'wheezy': {'labels': ['amd64', 'debian']}}},
+            overwrite=True
+        )
+
+    def test_matches_are_remembered(self):
+        with patch('mita.util.matching_nodes', return_value=['wheezy']) as m_matching:
+            assert util.match_node_from_label_expr('amd64&&debian') == 'wheezy'
+            assert util.match_node_from_label_expr('amd64&&debian') == 'wheezy'
+        assert m_matching.call_count == 1
+
+    def test_new_configuration_is_matched_again(self):
+        assert util.match_node_from_label_expr('amd64&&debian') == 'wheezy'
+        set_config({'nodes': {'trusty': {'labels': ['amd64']}}}, overwrite=True)
+        assert util.match_node_from_label_expr('amd64&&debian') is None
+
+    def test_explicit_configuration_is_not_remembered(self):
+        nodes = {'trusty': {'labels': ['amd64', 'ubuntu']}}
+        assert util.match_node_from_label_expr('amd64&&ubuntu', nodes) == 'trusty'
+        assert 'amd64&&ubuntu' not in util._nodes_cache['expr_matches']
+
+
 class TestFromOfflineExecutor(object):
     def setup(self):
         set_config(
@@ -307,6 +472,72 @@ class TestFromOfflineExecutor(object):
     def test_none_node_does_not_break(self):
         assert util.from_offline_executor(None) is None
 
+    def test_matches_a_node_with_ip(self):
+        assert util.from_offline_executor('centos6__192.168.168.90') == 'centos6'
+
+    def test_does_not_match_a_node(self):
+        assert util.from_offline_executor('rhel7') is None
+
+
+class TestGetJenkinsName(object):
+
+    def setup(self):
+        util._jenkins_nodes_cache['time'] = 0
+        self.conn = MagicMock()
+        self.conn.get_nodes.return_value = [
+            {'name': 'master'},
+            {'name': 'centos7__aaaa-1111'},
+            {'name': 'trusty__bbbb-2222-ip'},
+        ]
+
+    def test_finds_by_name_part(self):
+        with patch('mita.util.jenkins_connection', return_value=self.conn):
+            assert util.get_jenkins_name('aaaa-1111') == 'centos7__aaaa-1111'
+
+    def test_finds_by_substring(self):
+        with patch('mita.util.jenkins_connection', return_value=self.conn):
+            assert util.get_jenkins_name('bbbb-2222') == 'trusty__bbbb-2222-ip'
+
+    def test_nodes_are_cached(self):
+        with patch('mita.util.jenkins_connection', return_value=self.conn):
+            util.get_jenkins_name('aaaa-1111')
+            util.get_jenkins_name('bbbb-2222')
+        assert self.conn.get_nodes.call_count == 1
+
+    def test_refreshes_on_a_miss(self):
+        with patch('mita.util.jenkins_connection', return_value=self.conn):
+            util.get_jenkins_name('aaaa-1111')
+            self.conn.get_nodes.return_value = [{'name': 'centos7__cccc-3333'}]
+            assert util.get_jenkins_name('cccc-3333') == 'centos7__cccc-3333'
+
+    def test_not_found(self):
+        with patch('mita.util.jenkins_connection', return_value=self.conn):
+            assert util.get_jenkins_name('dddd-4444') is None
+
+
+class TestSanitizeString(object):
+
+    def test_removes_quotes(self):
+        assert util.sanitize_string(u'\u2018centos6\u2019') == u'centos6'
+
+    def test_strips(self):
+        assert util.sanitize_string(u' \u2018centos6\u2019 ', strip=True) == u'centos6'
+
+    def test_plain_string(self):
+        assert util.sanitize_string('centos6') == u'centos6'
+
+
+class TestNodeStateMap(object):
+
+    def test_maps_both_ways(self):
+        state_map = util.node_state_map()
+        assert state_map[state_map['RUNNING']] == 'RUNNING'
+
+    def test_skips_private_attributes(self):
+        state_map = util.node_state_map()
+        assert '__doc__' not in state_map
+        assert '__module__' not in state_map
+
 
 class TestJobFromUrl(object):
 
@@ -358,6 +589,11 @@ class TestMatchNodeFromMatrixJobName(object):
         result = util.match_node_from_matrix_job_name(job_name)
         assert result == "wheezy"
 
+    def test_labels_keep_their_order(self):
+        with patch('mita.util.match_node_from_labels') as m_match:
+            util.match_node_from_matrix_job_name("DIST=debian,ARCH=amd64,AVAILABLE_DIST=debian")
+        m_match.assert_called_once_with(['debian', 'amd64'])
+
 
 class TestMatchNodeFromJobConfig(object):
 
@@ -370,29 +606,85 @@ class TestMatchNodeFromJobConfig(object):
                 'token': 'secret'},
         }
         set_config(self.default_conf, overwrite=True)
+        util.clear_job_labels_cache()
 
-    @patch("mita.util.requests")
-    def test_finds_labels(self, m_requests):
+    @patch("mita.util.get_jenkins_session")
+    def test_finds_labels(self, m_session):
         mock_response = MagicMock()
-        job_config = '<?xml version="1.0" encoding="UTF-8"?><project><assignedNode>amd64 &amp;&amp; debian</assignedNode></project>'
-        mock_response.text = job_config
-        m_requests.get.return_value = mock_response
+        job_config = b'<?xml version="1.0" encoding="UTF-8"?><project><assignedNode>amd64 &amp;&amp; debian</assignedNode></project>'
+        mock_response.raw = BytesIO(job_config)
+        m_session.return_value.get.return_value = mock_response
         result = util.match_node_from_job_config("https://jenkins.ceph.com/job/ceph-pull-requests")
         assert result == "wheezy"
 
-    @patch("mita.util.requests")
-    def test_does_not_find_labels(self, m_requests):
+    @patch("mita.util.get_jenkins_session")
+    def test_does_not_find_labels(self, m_session):
         mock_response = MagicMock()
-        job_config = '<?xml version="1.0" encoding="UTF-8"?><project></project>'
-        mock_response.text = job_config
-        m_requests.get.return_value = mock_response
+        job_config = b'<?xml version="1.0" encoding="UTF-8"?><project></project>'
+        mock_response.raw = BytesIO(job_config)
+        m_session.return_value.get.return_value = mock_response
         result = util.match_node_from_job_config("https://jenkins.ceph.com/job/ceph-pull-requests")
         assert not result
 
-    @patch("mita.util.requests")
-    def test_failed_to_fetch_job_config(self, m_requests):
+    @patch("mita.util.get_jenkins_session")
+    def test_ignores_nested_assigned_node(self, m_session):
+        mock_response = MagicMock()
+        job_config = b'<?xml version="1.0" encoding="UTF-8"?><project><builders><assignedNode>amd64</assignedNode></builders></project>'
+        mock_response.raw = BytesIO(job_config)
+        m_session.return_value.get.return_value = mock_response
+        result = util.match_node_from_job_config("https://jenkins.ceph.com/job/ceph-pull-requests")
+        assert not result
+
+    @patch("mita.util.get_jenkins_session")
+    def test_failed_to_fetch_job_config(self, m_session):
         mock_response = MagicMock()
         mock_response.raise_for_status.side_effect = requests.exceptions.RequestException()
-        m_requests.get.return_value = mock_response
+        m_session.return_value.get.return_value = mock_response
         result = util.match_node_from_job_config("https://jenkins.ceph.com/job/ceph-pull-requests")
         assert not result
+
+    @patch("mita.util.get_jenkins_session")
+    def test_connection_error(self, m_session):
+        m_session.return_value.get.side_effect = requests.exceptions.ConnectionError()
+        result = util.match_node_from_job_config("https://jenkins.ceph.com/job/ceph-pull-requests")
+        assert not result
+
+    @patch("mita.util.get_jenkins_session")
+    def test_label_expression_is_cached(self, m_session):
+        def response(*a, **kw):
+            mock_response = MagicMock()
+            mock_response.raw = BytesIO(b'<project><assignedNode>amd64</assignedNode></project>')
+            return mock_response
+        m_session.return_value.get.side_effect = response
+        url = "https://jenkins.ceph.com/job/ceph-pull-requests"
+        assert util.match_node_from_job_config(url) == "wheezy"
+        assert util.match_node_from_job_config(url) == "wheezy"
+        assert m_session.return_value.get.call_count == 1
+
+    @patch("mita.util.get_jenkins_session")
+    def test_failures_are_not_cached(self, m_session):
+        m_session.return_value.get.side_effect = requests.exceptions.ConnectionError()
+        url = "https://jenkins.ceph.com/job/ceph-pull-requests"
+        util.match_node_from_job_config(url)
+        util.match_node_from_job_config(url)
+        assert m_session.return_value.get.call_count == 2
+
+    @patch("mita.util.get_jenkins_session")
+    def test_cache_is_bounded(self, m_session, monkeypatch):
+        monkeypatch.setattr(util, '_JOB_LABELS_MAX', 2)
+        def response(*a, **kw):
+            mock_response = MagicMock()
+            mock_response.raw = BytesIO(b'<project><assignedNode>amd64</assignedNode></project>')
+            return mock_response
+        m_session.return_value.get.side_effect = response
+        for job in ('a', 'b', 'c'):
+            util.match_node_from_job_config("https://jenkins.ceph.com/job/" + job)
+        assert list(util._job_labels) == [
+            "https://jenkins.ceph.com/job/b", "https://jenkins.ceph.com/job/c"
+        ]
+
+    def test_session_is_reused(self):
+        assert util.get_jenkins_session() is util.get_jenkins_session()
+
+    def test_session_uses_credentials(self):
+        assert util.get_jenkins_session().auth == ('alfredo', 'secret')
@@ -1,10 +1,16 @@
+from collections import OrderedDict
+from io import BytesIO
 from xml.etree import ElementTree
 from libcloud.compute import types
 from jenkins import NotFoundException as JenkinsNotFoundException
 from pecan import conf
 import logging
 import os
+import re
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 from mita.connections import jenkins_connection
 from mita.exceptions import CloudNodeNotFound
@@ -13,15 +19,23 @@ from mita.label_eval import matching_nodes
 
 logger = logging.getLogger(__name__)
 
+# translation table for ``unicode.translate`` that drops the cute quotes
+# Jenkins uses around labels and node names
+_QUOTES_TABLE = dict.fromkeys([ord(u'\u2018'), ord(u'\u2019')])
+
+# marker of the reason for a job stuck waiting on a node missing a label
+_DOESNT_HAVE_LABEL = u"doesn\u2019t have label"
 
 def sanitize_string(string, strip=False):
     """
     Remove all surrounding whitespace, and all utf-8 chars that are usually
     present coming from Jenkins
     """
-    to_remove = [u'\u2018', u'\u2019']
-    for i in to_remove:
-        string = string.replace(i, '')
+    if isinstance(string, bytes):
+        # Python 2 byte strings would get implicitly decoded by ``replace``
+        # when given a unicode argument, ``translate`` needs it done explicitly
+        string = string.decode('ascii')
+    string = string.translate(_QUOTES_TABLE)
     if strip:
         string = string.strip()
     return string
@@ -42,11 +56,15 @@ def node_state_map():
     we need a way to map a state *name* to its value and back and libcloud
     doesn't do this for us unless we call its tostring() and fromstring()
     methods but that is ugly.
+
+    Only the states themselves (upper case attributes) are mapped, leaving out
+    things like ``__doc__`` or the ``tostring()`` helpers.
     """
-    mapping = {}
-    for k, v in types.NodeState.__dict__.items():
-        mapping[k] = v
-        mapping[v] = k
+    states = dict(
+        (k, v) for k, v in types.NodeState.__dict__.items() if k.isupper()
+    )
+    mapping = dict(states)
+    mapping.update((v, k) for k, v in states.items())
     return mapping
 
 
@@ -68,7 +86,16 @@ def get_key(_dict, key, fallback=True):
     if key in _dict:
         return key
     if fallback:
-        for name in _dict.keys():
+        if _dict is _nodes_cache['value']:
+            names = _nodes_cache['names_sorted']
+            first_chars = _nodes_cache['first_chars'].intersection(key)
+        else:
+            names = sorted(_dict, key=len, reverse=True)
+            first_chars = None
+        # longest names first, so that the most specific one wins
+        for name in names:
+            if first_chars is not None and name[:1] not in first_chars:
+                continue
             if name in key:
                 return name
 
@@ -76,6 +103,12 @@ def get_key(_dict, key, fallback=True):
 # Stuck Queue Processors
 
 
+# Prefixes of the reasons for a stuck job that mita supports. Checked all at
+# once with ``str.startswith``, the two other reasons (an offline node, or a
+# node missing a label) are not at the start of the string.
+_STUCK_PREFIXES = ('Waiting for', 'All nodes of label', 'There are no nodes')
+
+
 def is_stuck(string):
     """
     The Jenkins API might not cooperate with proper information, when a job is
@@ -83,26 +116,11 @@ def is_stuck(string):
     status['stuck'] will be False. This helper will check for the strings that
     mita supports for stuck jobs.
     """
-    def busy_summary(string): return string.startswith('Waiting for')
-
-    def offline_label_summary(string): return string.startswith('All nodes of label')
-
-    def offline_node_summary(string): return string.endswith('is offline')
-
-    def offline_node_label_summary(string): return string.startswith('There are no nodes')
-
-    def node_does_not_have_label(string): return u"doesn\u2019t have label" in string
-
-    for summary in [
-        busy_summary,
-        offline_label_summary,
-        offline_node_summary,
-        offline_node_label_summary,
-        node_does_not_have_label
-    ]:
-        if summary(string) is True:
-            return True
-    return False
+    return (
+        string.startswith(_STUCK_PREFIXES) or
+        string.endswith('is offline') or
+        _DOESNT_HAVE_LABEL in string
+    )
 
 
 def match_node(string):
@@ -111,15 +129,16 @@ def match_node(string):
     Queue. There are three distinct states from the API, so process it and
     determine if we are able to match it to a configured node.
     """
-    busy_summary = lambda string: from_label if string.startswith('Waiting for') else None
-    offline_label_summary = lambda string: from_offline_label if string.startswith('All nodes of label') else None
-    offline_node_summary = lambda string: from_offline_node if string.endswith('is offline') else None
-    offline_node_label_summary = lambda string: from_offline_node_label if string.startswith('There are no nodes') else None
-    node_does_not_have_label = lambda string: from_node_without_label if u"doesn\u2019t have label" in string else None
-    for summary in [busy_summary, offline_label_summary, offline_node_summary, offline_node_label_summary, node_does_not_have_label]:
-        processor = summary(string)
-        if processor:
-            return processor(string)
+    if string.startswith('Waiting for'):
+        return from_label(string)
+    elif string.startswith('All nodes of label'):
+        return from_offline_label(string)
+    elif string.endswith('is offline'):
+        return from_offline_node(string)
+    elif string.startswith('There are no nodes'):
+        return from_offline_node_label(string)
+    elif _DOESNT_HAVE_LABEL in string:
+        return from_node_without_label(string)
 
 
 def from_label(string):
@@ -139,40 +158,37 @@ def from_label(string):
     processing.
     """
     try:
-        node_or_label = string.split()[-1]
+        node_or_label = string.rsplit(None, 1)[-1]
     except IndexError:
         return None
     node_or_label = sanitize_string(node_or_label)
-    node_from_label = match_node_from_label(node_or_label)
     configured_nodes = get_nodes()
-    # node_or_label can be a node as a key in the config, so try to get that
-    # first, and use the match from labels as a fallback. Try first with no
-    # sanitizing of the node name, and if that doesn't work, try by splitting
-    # on possible use of '__IP'
-    match = get_key(configured_nodes, node_or_label) or get_key(configured_nodes, node_from_label)
-    if match is None:
-        clean_node = node_or_label.split('__')[0]
-        match = get_key(configured_nodes, clean_node)
+    # the cheapest check first: node_or_label is a node as a key in the config
+    if node_or_label in configured_nodes:
+        return node_or_label
+
+    # Then a node name that includes a configured one (like with the use of
+    # '__IP'), and then a label of a configured node
+    match = (
+        get_key(configured_nodes, node_or_label) or
+        match_node_from_label(node_or_label)
+    )
+    if match is not None:
+        return match
 
     # maybe we have a label expression and not just a single label
-    if match is None:
-        matched_node = match_node_from_label_expr(
-            node_or_label, configured_nodes
-        )
-        if matched_node:
-            return matched_node
+    matched_node = match_node_from_label_expr(node_or_label, configured_nodes)
+    if matched_node:
+        return matched_node
 
     # It is possible that we got a custom node name with no
     # naming conventions that would allow mita to understand
     # what it needs to be built, so go and get the labels of
     # this custom node and see if we can match them
-    if match is None:
-        logger.warning('unable to match: %s', node_or_label)
-        logger.warning('will look at node labels and attempt a match')
-        # node_or_label will now probably be a node with a custom name
-        match = match_node_from_labels(get_node_labels(node_or_label))
-
-    return match
+    logger.warning('unable to match: %s', node_or_label)
+    logger.warning('will look at node labels and attempt a match')
+    # node_or_label will now probably be a node with a custom name
+    return match_node_from_labels(get_node_labels(node_or_label))
 
 
 def from_offline_node_label(string):
@@ -191,7 +207,7 @@ def from_offline_node_label(string):
         u"There are no nodes with the label \u2018{0}\u2019"
     """
     string = sanitize_string(string)
-    label = string.split()[-1]
+    label = string.rsplit(None, 1)[-1]
     matched_node = match_node_from_label(label)
     if matched_node is None:
         nodes = get_nodes()
@@ -209,7 +225,7 @@ def from_offline_label(string):
     """
     # effing unicode to have nice cute quotes in the UI
     string = sanitize_string(string)
-    label = string.split()[-3]
+    label = string.rsplit(None, 3)[-3]
     # first check if we get a match from a single label, e.g. 'amd64'
     single_label_match = match_node_from_label(label)
     # otherwise, fallback to multi-labels, like 'amd64&&trusty'
@@ -218,22 +234,29 @@ def from_offline_label(string):
     return single_label_match
 
 
+def _resolve_configured_node(node):
+    """
+    Map a Jenkins node name to a configured node. The name can be a key in the
+    config, or have it as a part of it like ``name__IP``, which get_key falls
+    back to. The outcome is remembered since the same Jenkins nodes show up on
+    every queue check.
+    """
+    configured_nodes = get_nodes()
+    shortnames = _nodes_cache['shortnames']
+    if node not in shortnames:
+        if len(shortnames) >= _SHORTNAMES_MAX:
+            shortnames.clear()
+        shortnames[node] = get_key(configured_nodes, node)
+    return shortnames[node]
+
+
 def from_offline_node(string):
     """
     String to process::
 
         "{0} is offline"
     """
-    node = string.split()[0]
-    configured_nodes = get_nodes()
-    # node can be a node as a key in the config, so try to get that first. Try
-    # first with no sanitizing of the node name, and if that doesn't work, try
-    # by splitting on possible use of __IP'
-    match = get_key(configured_nodes, node)
-    if match is None:
-        node = node.split('__')[0]
-        match = node if node in configured_nodes else None
-    return match
+    return _resolve_configured_node(string.split(None, 1)[0])
 
 
 def from_offline_executor(node):
@@ -243,15 +266,7 @@ def from_offline_executor(node):
     """
     if node is None:
         return None
-    configured_nodes = get_nodes()
-    # node can be a node as a key in the config, so try to get that first. Try
-    # first with no sanitizing of the node name, and if that doesn't work, try
-    # by splitting on possible use of __IP'
-    match = get_key(configured_nodes, node)
-    if match is None:
-        node = node.split('__')[0]
-        match = node if node in configured_nodes else None
-    return match
+    return _resolve_configured_node(node)
 
 
 def from_node_without_label(string):
@@ -260,9 +275,11 @@ def from_node_without_label(string):
 
         u"... {0} doesn\u2019t have label ..."
     """
+    if _DOESNT_HAVE_LABEL not in string:
+        return None
     messages = string.split(';')
     for message in messages:
-        if u"doesn\u2019t have label" in message:
+        if _DOESNT_HAVE_LABEL in message:
             node = from_label(message)
             if not node:
                 continue
@@ -270,8 +287,19 @@ def from_node_without_label(string):
     logger.warning('tried to match a node without label but failed')
 
 
+def _is_cached_config(configured_nodes):
+    """
+    The indexes built by ``get_nodes()`` can only be used for the cached
+    configuration, so tell if ``configured_nodes`` is (or defaults to) it.
+    """
+    nodes = get_nodes()
+    return not configured_nodes or configured_nodes is nodes
+
+
 def match_node_from_label(label, configured_nodes=None):
-    configured_nodes = configured_nodes or get_nodes()
+    if _is_cached_config(configured_nodes):
+        matches = _nodes_cache['by_label'].get(label)
+        return matches[0] if matches else None
     for node, metadata in configured_nodes.items():
         if label in metadata['labels']:
             return node
@@ -284,16 +312,15 @@ def match_node_from_labels(labels, configured_nodes=None):
     """
     if not labels:
         return
-    configured_nodes = configured_nodes or get_nodes()
-
-    def labels_exist(config):
-        for l in labels:
-            if l not in config:
-                return False
-        return True
+    required = frozenset(labels)
+    if _is_cached_config(configured_nodes):
+        for node, node_labels in _nodes_cache['label_sets'].items():
+            if node_labels >= required:
+                return node
+        return
 
     for node, metadata in configured_nodes.items():
-        if labels_exist(metadata['labels']):
+        if required.issubset(metadata['labels']):
             return node
 
 
@@ -304,9 +331,18 @@ def match_node_from_label_expr(expr, configured_nodes=None):
     """
     if not expr:
         return
-    configured_nodes = configured_nodes or get_nodes()
-
-    matches = matching_nodes(expr, configured_nodes)
+    if _is_cached_config(configured_nodes):
+        # expressions repeat a lot (e.g. for every item of a matrix build) so
+        # remember what they matched for as long as the configuration is
+        # cached, refilling the cache resets this too
+        expr_matches = _nodes_cache['expr_matches']
+        if expr not in expr_matches:
+            if len(expr_matches) >= _EXPR_MATCHES_MAX:
+                expr_matches.clear()
+            expr_matches[expr] = tuple(matching_nodes(expr, get_nodes()))
+        matches = expr_matches[expr]
+    else:
+        matches = matching_nodes(expr, configured_nodes)
     # XXX return first?  random?  try to figure out if
     # one is already provisioning and return it?
     if matches:
@@ -315,7 +351,46 @@ def match_node_from_label_expr(expr, configured_nodes=None):
         return None
 
 
+# Converting the configured nodes to a dict makes a deep copy of them, and it
+# is needed by almost every matcher. Keep the result, along with some indexes
+# derived from it, until the configuration object changes. ``version`` is
+# bumped every time the cache is filled.
+_nodes_cache = {
+    'source': None,
+    'version': 0,
+    'value': None,
+    'by_label': None,
+    'label_sets': None,
+    'names_sorted': None,
+    'first_chars': None,
+    'shortnames': None,
+    'expr_matches': None,
+}
+
+# Jenkins node names resolved to a configured node (or None) are kept in
+# ``_nodes_cache['shortnames']``, but never more than this many of them.
+_SHORTNAMES_MAX = 1024
+
+# Same for the label expressions matched in ``_nodes_cache['expr_matches']``
+_EXPR_MATCHES_MAX = 1024
+
+
 def get_nodes():
+    source = conf['nodes']
+    if _nodes_cache['source'] is not source:
+        _fill_nodes_cache(source)
+    return _nodes_cache['value']
+
+
+def invalidate_nodes_cache():
+    """
+    Force the next call to ``get_nodes()`` to read the configuration again,
+    useful if it was modified in place.
+    """
+    _nodes_cache['source'] = None
+
+
+def _fill_nodes_cache(source):
     # Note:
     # There is some odd side-effect of the pecan configuration where in
     # production you can get a ``pecan.configuration.Config`` object but in
@@ -324,9 +399,31 @@ def get_nodes():
     # if/when this is fixed in how the celery portion of the apps loads the config then
     # this should be removed.
     try:
-        return conf['nodes'].to_dict()
+        nodes = source.to_dict()
     except AttributeError:
-        return conf['nodes']
+        nodes = source
+
+    by_label = {}
+    label_sets = {}
+    for node, metadata in nodes.items():
+        labels = metadata.get('labels', [])
+        label_sets[node] = frozenset(labels)
+        for label in labels:
+            by_label.setdefault(label, []).append(node)
+
+    # the source is kept around (rather than its id) so that it can't be
+    # garbage collected and have its id reused by a new configuration
+    _nodes_cache.update(
+        source=source,
+        version=_nodes_cache['version'] + 1,
+        value=nodes,
+        by_label=by_label,
+        label_sets=label_sets,
+        names_sorted=tuple(sorted(nodes, key=len, reverse=True)),
+        first_chars=frozenset(name[:1] for name in nodes),
+        shortnames=dict((name, name) for name in nodes),
+        expr_matches={},
+    )
 
 
 def get_jenkins_name(uuid):
@@ -334,14 +431,71 @@ def get_jenkins_name(uuid):
     Given a node's identifier use the jenkins api to find a node name in jenkins
     that includes that uuid and return it.
     """
+    fetched = False
+    if time.time() - _jenkins_nodes_cache['time'] > JENKINS_NODES_TTL:
+        _refresh_jenkins_nodes()
+        fetched = True
+    name = _find_jenkins_name(uuid)
+    if name is None and not fetched:
+        # the node might have been added since the last refresh
+        _refresh_jenkins_nodes()
+        name = _find_jenkins_name(uuid)
+    return name
+
+
+# Nodes registered in Jenkins, fetched at most every ``JENKINS_NODES_TTL``
+# seconds. ``index`` maps every '__' separated part of a node name to the
+# full name, so that a node can be found by its identifier right away.
+JENKINS_NODES_TTL = 5
+_jenkins_nodes_cache = {
+    'time': 0,
+    'names': [],
+    'index': {},
+}
+
+
+def _refresh_jenkins_nodes():
     conn = jenkins_connection()
-    nodes = conn.get_nodes()
-    for node in nodes:
-        if uuid in node['name']:
-            return node['name']
+    names = [node['name'] for node in conn.get_nodes()]
+    index = {}
+    for name in names:
+        for part in name.split('__'):
+            index.setdefault(part, name)
+    _jenkins_nodes_cache.update(time=time.time(), names=names, index=index)
+
+
+def _find_jenkins_name(uuid):
+    name = _jenkins_nodes_cache['index'].get(uuid)
+    if name is not None:
+        return name
+    # the identifier may not be a whole part of the name
+    for name in _jenkins_nodes_cache['names']:
+        if uuid in name:
+            return name
     return None
 
 
+def find_top_level_text(stream, tag):
+    """
+    Stream-parse an XML document (like the configuration of a node or a job)
+    and return the text of the first ``tag`` that is a direct child of the root
+    element, stopping as soon as it is found. Raises ``LookupError`` if there
+    is no such tag.
+    """
+    depth = 0
+    for event, element in ElementTree.iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        # depth is 1 for the direct children of the root element
+        if depth == 1:
+            if element.tag == tag:
+                return element.text
+            element.clear()
+    raise LookupError(tag)
+
+
 def get_node_labels(node_name, _xml_configuration=None):
     """
     Useful when a custom node was added with a name that mita does not
@@ -357,13 +511,15 @@ def get_node_labels(node_name, _xml_configuration=None):
     except JenkinsNotFoundException:
         logging.warning('"%s" was not found in Jenkins', node_name)
         return []
-    xml_object = ElementTree.fromstring(xml_configuration)
-    for node in xml_object:
-        if node.tag == 'label':
-            # node labels are in this tag, parse the text. The XML should look
-            # like:  <label>amd64 centos7 x86_64 huge</label>
-            return node.text.split()
-    return []
+    if not isinstance(xml_configuration, bytes):
+        xml_configuration = xml_configuration.encode('utf-8')
+    try:
+        # node labels are in this tag, parse the text. The XML should look
+        # like:  <label>amd64 centos7 x86_64 huge</label>
+        labels = find_top_level_text(BytesIO(xml_configuration), 'label')
+    except LookupError:
+        return []
+    return labels.split() if labels else []
 
 
 def delete_jenkins_node(name):
@@ -378,37 +534,110 @@ def delete_jenkins_node(name):
     logger.info("Node does not exist in Jenkins, cannot delete")
 
 
-def delete_provider_node(provider, name):
+def delete_provider_node(provider, name, uuid=None, volume_uuid=None):
     # we need to terminate this couch potato
     logger.info("Destroying cloud node: %s" % name)
     try:
-        provider.destroy_node(name=name)
+        provider.destroy_node(name=name, uuid=uuid, volume_uuid=volume_uuid)
     except CloudNodeNotFound:
         logger.info("Node does not exist in cloud provider, cannot delete")
     except Exception:
         logger.exception("encountered errors while trying to delete node from cloud provider")
 
 
-def match_node_from_job_config(job_url):
+# Session used to talk to the Jenkins API directly, created on first use
+# because the configuration is not loaded at import time. Reusing it keeps
+# the connections to Jenkins alive between requests.
+_jenkins_session = None
+
+
+def get_jenkins_session():
+    global _jenkins_session
+    auth = (conf.jenkins['user'], conf.jenkins['token'])
+    if _jenkins_session is None or _jenkins_session.auth != auth:
+        session = requests.Session()
+        session.auth = auth
+        adapter = HTTPAdapter(
+            pool_maxsize=32,
+            max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=(502, 503, 504)),
+        )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _jenkins_session = session
+    return _jenkins_session
+
+
+# Label expressions of jobs, keyed by job url, so that a busy queue with many
+# items for the same job fetches its configuration only once. Entries expire
+# after ``JOB_LABELS_TTL`` seconds to pick up changes to the job, and only the
+# ``_JOB_LABELS_MAX`` most recently used are kept.
+JOB_LABELS_TTL = 600
+_JOB_LABELS_MAX = 512
+_job_labels = OrderedDict()
+
+
+def clear_job_labels_cache():
+    _job_labels.clear()
+
+
+def get_job_label_expression(job_url):
+    """
+    Return the label expression a job is restricted to (its ``assignedNode``)
+    or ``None`` if it could not be found.
+    """
+    now = time.time()
+    cached = _job_labels.pop(job_url, None)
+    if cached is not None and now - cached[0] < JOB_LABELS_TTL:
+        # re-insert to mark it as the most recently used
+        _job_labels[job_url] = cached
+        return cached[1]
+    label_expression = _fetch_label_expression(job_url)
+    if label_expression is not None:
+        _job_labels[job_url] = (now, label_expression)
+        while len(_job_labels) > _JOB_LABELS_MAX:
+            _job_labels.popitem(last=False)
+    return label_expression
+
+
+def _fetch_label_expression(job_url):
     config_url = os.path.join(job_url, "config.xml")
     logger.info("Getting job config from: %s", config_url)
-    response = requests.get(config_url, auth=(conf.jenkins['user'], conf.jenkins['token']))
+    try:
+        response = get_jenkins_session().get(config_url, timeout=(3, 10), stream=True)
+    except requests.exceptions.RequestException:
+        logger.exception("failed to retrieve job config from: %s", job_url)
+        return None
     try:
         response.raise_for_status()
     except Exception:
         logger.exception("failed to retrieve job config from: %s", job_url)
+        response.close()
         return None
-    element_tree = ElementTree.fromstring(response.text)
+    # parse the raw stream rather than the decoded text, but let urllib3
+    # undo any gzip transfer encoding
+    response.raw.decode_content = True
     try:
-        label_expression = element_tree.find('assignedNode').text
-    except AttributeError:
+        return find_top_level_text(response.raw, 'assignedNode')
+    except LookupError:
         logger.warning("Did not find 'assignedNode' in job config %s", job_url)
         return None
+    finally:
+        response.close()
+
+
+def match_node_from_job_config(job_url):
+    label_expression = get_job_label_expression(job_url)
+    if label_expression is None:
+        return None
     logger.info("Found label expression: %s", label_expression)
     node = match_node_from_label_expr(label_expression)
     return node
 
 
+# the value of each ``KEY=value`` pair in a matrix job name
+_MATRIX_VALUE_RE = re.compile(r'(?:^|,)[^,=]*=([^,=]*)')
+
+
 def match_node_from_matrix_job_name(job_name):
     """
     A matrix job name will look something like:
@@ -416,9 +645,8 @@ def match_node_from_matrix_job_name(job_name):
     ARCH=x86_64,AVAILABLE_ARCH=x86_64,AVAILABLE_DIST=xenial,DIST=xenial,MACHINE_SIZE=huge
     """
     logger.info("Infering labels from matrix job_name: %s", job_name)
-    labels = job_name.split(",")
-    labels = [label.split("=")[1] for label in labels]
-    labels = list(set(labels))
+    # keep the labels in the order they appear, without duplicates
+    labels = list(OrderedDict.fromkeys(_MATRIX_VALUE_RE.findall(job_name)))
     logger.info("Found labels: %s", labels)
     node = match_node_from_labels(labels)
     return node
@@ -21,6 +21,7 @@ setup(
         'python-jenkins',
         'alembic',
         'gunicorn',
+        'futures; python_version < "3.0"',
     ],
     test_suite='mita',
     zip_safe=False,